@@ -0,0 +1,88 @@
+#board.py
+# array-backed gamestates (optional, needs numpy). a Board keeps its robots
+# in one structured array sorted by robot id, ~9 bytes per robot instead of
+# a dict each, so it is cheap to keep as history and to diff against the
+# previous turn without python loops. the 19x19 hp, player_id and robot_id
+# planes are built on first use.
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from rgkit.gamestate import GameState
+
+board_size = 19
+
+if numpy is not None:
+    bot_dtype = numpy.dtype([('id', '<i4'), ('x', 'u1'), ('y', 'u1'),
+                             ('player_id', 'i1'), ('hp', '<i2')])
+
+
+class Board(object):
+    empty = {'hp': 0, 'player_id': -1, 'id': -1}
+
+    def __init__(self, turn, bots):
+        """`bots` is a structured array of `bot_dtype` sorted by id."""
+        self.turn = turn
+        self.bots = bots
+        self._planes = {}
+
+    @classmethod
+    def from_gamestate(cls, gamestate):
+        if numpy is None:
+            raise ImportError("Board needs numpy")
+        bots = numpy.array(sorted(
+            (bot['robot_id'], loc[0], loc[1], bot['player_id'], bot['hp'])
+            for loc, bot in gamestate.robots.iteritems()), dtype=bot_dtype)
+        return cls(gamestate.turn, bots)
+
+    def to_gamestate(self):
+        gs = GameState(turn=self.turn)
+        for robot_id, x, y, player_id, hp in self.bots.tolist():
+            gs.add_robot((x, y), player_id, hp, robot_id)
+        return gs
+
+    def plane(self, field):
+        """19x19 array of `field` ('hp', 'player_id' or 'id') indexed by
+        [x, y], Board.empty[field] where there is no robot."""
+        try:
+            return self._planes[field]
+        except KeyError:
+            plane = numpy.empty((board_size, board_size),
+                                dtype=bot_dtype[field])
+            plane.fill(self.empty[field])
+            plane[self.bots['x'], self.bots['y']] = self.bots[field]
+            self._planes[field] = plane
+            return plane
+
+    @property
+    def hp(self):
+        return self.plane('hp')
+
+    @property
+    def player_id(self):
+        return self.plane('player_id')
+
+    @property
+    def robot_id(self):
+        return self.plane('id')
+
+    def diff(self, base):
+        """Changes from the Board `base` to this one: (spawned bots, removed
+        ids, changed bots, moved, hp changed), the last two are masks over
+        the changed bots."""
+        ids, base_ids = self.bots['id'], base.bots['id']
+        kept = numpy.isin(ids, base_ids, assume_unique=True)
+        base_kept = numpy.isin(base_ids, ids, assume_unique=True)
+        # both sorted by id, so the kept bots line up
+        new, old = self.bots[kept], base.bots[base_kept]
+        moved = (new['x'] != old['x']) | (new['y'] != old['y'])
+        hurt = new['hp'] != old['hp']
+        changed = moved | hurt
+        return (self.bots[~kept], base_ids[~base_kept], new[changed],
+                moved[changed], hurt[changed])
+
+    @property
+    def nbytes(self):
+        return self.bots.nbytes + sum(p.nbytes for p in self._planes.values())
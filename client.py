@@ -3,11 +3,18 @@
 
 import sys
 import time
+import errno
+import heapq
+import select
 import socket
+import itertools
+import collections
 import match_pb2
 from urlparse import urlparse
 
-from serialization import PB2Interface
+from serialization import codecs, DeltaError
+import compression
+import framing
 
 class ConnectionClosed(Exception):
     pass
@@ -15,149 +22,496 @@ class ConnectionClosed(Exception):
 class ProtocolError(Exception):
     pass
 
+class MatchFailed(Exception):
+    pass
+
 def netstring(s=''):
     return str(len(s)) + ":" + s + ","
 
+class NetstringDecoder(object):
+    """Incremental netstring decoder. feed() returns every frame completed
+    by the new data, partial frames are kept in a reused buffer. Binary
+    frames are parsed into (tag, state, payload) straight from the buffer,
+    other frames are returned as strings."""
+    max_prefix_length = 10
+
+    def __init__(self):
+        self.buf = bytearray()
+
+    def feed(self, data):
+        buf = self.buf
+        buf += data
+        frames = []
+        pos = 0
+        while True:
+            colon = buf.find(':', pos)
+            if colon < 0:
+                if len(buf) - pos > self.max_prefix_length:
+                    raise ProtocolError("Netstring length prefix too long")
+                break
+            prefix = str(buf[pos:colon])
+            # int() would also take signs and spaces
+            if not prefix.isdigit() or len(prefix) > self.max_prefix_length:
+                raise ProtocolError("Invalid netstring length prefix")
+            length = int(prefix)
+            end = colon + 1 + length
+            if len(buf) <= end:
+                break
+            if buf[end] != ord(','):
+                raise ProtocolError("Missing netstring terminator")
+            if length and buf[colon + 1] in framing.kinds:
+                try:
+                    frames.append(framing.parse(buf, colon + 1, end))
+                except framing.FramingError as e:
+                    raise ProtocolError(str(e))
+            else:
+                frames.append(memoryview(buf)[colon + 1:end].tobytes())
+            pos = end + 1
+        if pos:
+            del buf[:pos]
+        return frames
+
 class MatchRunner():
-    def __init__(self, fname):
+    bufsize = 65536
+
+    def __init__(self, fname, deltas=True, verbose=True, codec='pb2',
+                 queue=False, compress=False, binary=False, boards=False):
         self.state = 'DISCONNECTED'
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        #self.socket.setblocking(0)
-        self.oldbuf = ""
-        self.serializer = PB2Interface()
+        self.decoder = NetstringDecoder()
+        self.frames = collections.deque()
+        self.recv_buf = bytearray(self.bufsize)
+        self.outbuf = bytearray()
+        self.loop = None  # ClientLoop driving this runner, None if blocking
+        self.codec = codec
+        self.serializer = codecs[codec]
+        self.binary = binary  # binary frames, see framing.py
+        # replies before joining
+        self.handshake = 1 + (codec != 'pb2') + binary
         self.states = {} # turn -> gamestate (for history)
+        self.boards = boards  # keep the history as Boards, needs numpy
+        self.gamestate = None
+        self.deltas = deltas
+        self.verbose = verbose
+        self.queue = queue  # matchmaking, the server starts the match
+        self.inflater = compression.Inflater() if compress else None
+        self.finished = False
+        self.i = 0  # messages handled
     
         self.fname = fname
     
     def send(self, data):
         # print "Sending:", repr(data)
-        self.socket.sendall(netstring(data))
+        if self.loop is None:
+            self.socket.sendall(netstring(data))
+        else:
+            self.outbuf += netstring(data)
         
+    def flush(self):
+        # write as much of the queued output as the socket accepts
+        try:
+            n = self.socket.send(self.outbuf)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise ConnectionClosed
+        del self.outbuf[:n]
+
+    def read(self):
+        # read once from the socket, queue the completed frames
+        try:
+            n = self.socket.recv_into(self.recv_buf)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise ConnectionClosed
+        if n == 0:
+            raise ConnectionClosed
+        for frame in self.decoder.feed(memoryview(self.recv_buf)[:n]):
+            if not isinstance(frame, tuple):
+                frame = self.parse_frame(frame)
+            self.frames.append(frame)
+
+    def parse_frame(self, frame):
+        # (tag, state, payload) of a compressed or text frame
+        if self.inflater is not None:
+            frame = self.inflater.decompress(frame)
+        if framing.is_binary(frame):
+            try:
+                return framing.parse(frame)
+            except framing.FramingError as e:
+                raise ProtocolError(str(e))
+        return framing.parse_text(frame)
+
     def recv(self):
-        suffix_length = 1
-        min_prefix_length = 2
-        bufsize = 2048
-        s = ""
-        data = self.oldbuf
-        data_len_to_receive = len(netstring())
-        
-        n_chunks = 0
-        while len(data) < data_len_to_receive or n_chunks == 0:
-            if len(data) < data_len_to_receive:
-                try:
-                    chunk = self.socket.recv(bufsize)
-                except socket.error:
-                    raise ConnectionClosed
-                if chunk == '':
-                    raise ConnectionClosed
-                data += chunk
-            if n_chunks == 0:
-                i = data.find(':')
-                string_length = int(data[:i])
-                prefix_length = i+1
-                data_len_to_receive = prefix_length+string_length+suffix_length
-            n_chunks += 1
-        
-        self.oldbuf = data[data_len_to_receive:]
-        if self.oldbuf:
-            print "data:", repr(data[prefix_length:prefix_length+string_length]), "oldbuf:",repr(self.oldbuf)
-            raise ProtocolError("Multiple messages received")
-        
-        return data[prefix_length:prefix_length+string_length]
+        while not self.frames:
+            self.read()
+        return self.frames.popleft()
+
+    def later(self, delay, f, *args):
+        if self.loop is None:
+            time.sleep(delay)
+            f(*args)
+        else:
+            self.loop.call_later(delay, f, *args)
+
+    def decode_gamestate(self, base, gamestate_str):
+        # raises DeltaError if a delta does not apply to base
+        if not self.deltas:
+            return self.serializer.deserialize_gamestate(gamestate_str)
+        return self.serializer.apply_delta(base, gamestate_str)
     
+    def receive_gamestate(self, gamestate_str):
+        try:
+            gs = self.decode_gamestate(self.gamestate, gamestate_str)
+        except DeltaError:
+            self.send('KEYFRAME')
+            return None
+        self.gamestate = gs
+        if self.boards:
+            import board  # numpy, only with --boards
+            self.states[gs.turn] = board.Board.from_gamestate(gs)
+        else:
+            self.states[gs.turn] = gs
+        return gs
     
     def disconnect(self):
-        self.socket.shutdown(socket.SHUT_RDWR)
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
         self.socket.close() 
     
     def exit(self):
         self.disconnect()
         sys.exit(1)
     
-    def join_or_create_match(self, uri_str):
-        uri = urlparse(uri_str)
-        host, port = uri.netloc.split(':')
+    def connect(self, uri_str):
+        self.uri_str = uri_str
+        self.uri = urlparse(uri_str)
+        host, port = self.uri.netloc.split(':')
         self.socket.connect((host, int(port)))
         
-        i = 0
-        while True:
+    def join_or_create_match(self, uri_str):
+        self.connect(uri_str)
+
+        while not self.finished:
             try:
                 msg = self.recv()
+                self.handle(msg)
             except ConnectionClosed:
                 print "Connection closed"
-                if self.state != 'ENDED':
-                    sys.exit(1)
-                else:
-                    pass
-            spl = msg.split(' ')
-            self.state = spl[0]
-            msg2 = ' '.join(spl[1:])
+                sys.exit(1)
+            except MatchFailed as e:
+                print e
+                self.exit()
+
+    def handle(self, frame):
+        tag, self.state, msg2 = frame
+        
+        if self.state == 'QUEUED':
+            print msg2
+            return
+        elif self.state == 'CONNECTED':
+            if self.i == 0:
+                self.send(self.name_command())
+                if self.codec != 'pb2':
+                    self.send('CODEC {}'.format(self.codec))
+                if self.binary:
+                    self.send('BINARY {}'.format(framing.version))
             
-            #print repr(msg)
+            elif self.i > self.handshake: #by now we should be joined
+                raise MatchFailed("Joining match failed.")
             
-            if self.state == 'CONNECTED':
-                if i == 0:
-                    self.send('NAME {}'.format(self.fname))
-                
-                elif i > 1: #by message #2 we should be joined
-                    print "Joining match failed."
-                    self.exit()
-                
-                elif uri.path[1:]:
-                    print "Joining match {}...".format(uri_str)
-                    self.send('JOIN {}'.format(uri.path[1:]))
-                else:
-                    print "Creating match..."
-                    self.send('CREATE num_players=2')
-            elif self.state == 'JOINED':
-                self.match_uri = msg2.split(' ')[0]
-                print "Joined {}".format(msg2)
-                
-                time.sleep(1)
-                self.send('START')
-            elif self.state == 'STARTED':
-                sett, self.player_id = self.serializer.deserialize_settings(msg2)
-                # TODO: actually apply settings
-                
-                self.send('TURN')
-            elif self.state == 'TURN':
-                # decode state...
-                gs = self.serializer.deserialize_gamestate(msg2)
-                self.states[gs.turn] = gs
+            elif self.i < self.handshake:
+                pass
+            
+            elif self.queue:
+                self.send('QUEUE 2')
+            
+            elif self.uri.path[1:]:
+                print "Joining match {}...".format(self.uri_str)
+                self.send('JOIN {}'.format(self.uri.path[1:]))
+            else:
+                print "Creating match..."
+                self.send('CREATE num_players=2')
+        elif self.state == 'SEARCHING':
+            print msg2
+        elif self.state == 'JOINED':
+            self.match_uri = msg2.split(' ')[0]
+            print "Joined {}".format(msg2)
+            
+            if not self.queue:
+                self.later(1, self.send, 'START')
+        elif self.state == 'STARTED':
+            sett, self.player_id = self.serializer.deserialize_settings(msg2)
+            # TODO: actually apply settings
+            
+            self.send('TURN DELTA' if self.deltas else 'TURN')
+        elif self.state == 'TURN':
+            # decode state...
+            gs = self.receive_gamestate(msg2)
+            if gs is None:  # out of sync, keyframe requested
+                self.i += 1
+                return
+            if self.verbose:
                 print "Running turn {}".format(gs.turn)
                 
                 
-                actions = {}; bots = {}
-                # calculate actions
-                #time.sleep(0.1) #mediumslowbot
-                print gs.robots
-                for loc, bot in gs.robots.items():
-                    if bot['player_id'] == self.player_id:
-                        actions[loc] = ('GUARD',)
-                        bots[loc] = bot
-                
-                #send actions
-                actions_str = self.serializer.serialize_actions(
-                    actions, bots, turn=gs.turn)
-                self.send('TURN {}'.format(actions_str))
-            elif self.state == 'ENDED':
-                gs = self.serializer.deserialize_gamestate(msg2)
-                self.states[gs.turn] = gs
-                self.do_end_stuff()
-                break
-            i += 1
+            #send actions
+            self.send('TURN {}'.format(self.actions_str(gs, self.player_id)))
+        elif self.state == 'ENDED':
+            self.receive_gamestate(msg2)
+            self.do_end_stuff()
+            self.finished = True
+        self.i += 1
+
+    def name_command(self):
+        if self.inflater is not None:
+            return 'NAME {} compress=zlib'.format(self.fname)
+        return 'NAME {}'.format(self.fname)
+
+    def handle_frames(self):
+        while self.frames and not self.finished:
+            self.handle(self.frames.popleft())
+
+    def actions_str(self, gs, player_id):
+        actions = {}; bots = {}
+        # calculate actions
+        #time.sleep(0.1) #mediumslowbot
+        if self.verbose:
+            print gs.robots
+        for loc, bot in gs.robots.items():
+            if bot['player_id'] == player_id:
+                actions[loc] = ('GUARD',)
+                bots[loc] = bot
+        
+        return self.serializer.serialize_actions(actions, bots, turn=gs.turn)
     
     def do_end_stuff(self):
         print "Game finished sucessfully, Score: ? ?:? ?"
 
 
+class MuxMatch(object):
+    def __init__(self):
+        self.state = None
+        self.player_id = None
+        self.gamestate = None
+
+
+class MuxRunner(MatchRunner):
+    """Plays many matches over one connection. Creates `create` matches and
+    joins the match ids in `join`, the actions of all matches whose state
+    arrived in the same read are sent in one BATCH frame."""
+    def __init__(self, fname, create=0, join=(), num_players=2,
+                 deltas=True, verbose=True, codec='pb2', compress=False,
+                 binary=False):
+        MatchRunner.__init__(self, fname, deltas=deltas, verbose=verbose,
+                             codec=codec, compress=compress, binary=binary)
+        self.handshake += 1  # MUX
+        self.create = create
+        self.join = list(join)
+        self.num_players = num_players
+        self.matches = {}  # match_id -> MuxMatch
+        self.pending = []  # tagged commands, sent by flush_batch
+        self.expected = create + len(self.join)
+        self.ended = 0
+        self.failed = 0
+
+    def run(self, uri_str):
+        loop = ClientLoop()
+        loop.add(self, uri_str)
+        loop.run()
+
+    def handle_frames(self):
+        MatchRunner.handle_frames(self)
+        self.flush_batch()
+
+    def flush_batch(self):
+        if len(self.pending) == 1:
+            self.send(self.pending[0])
+        elif self.pending:
+            self.send('BATCH ' + ''.join(netstring(p) for p in self.pending))
+        self.pending = []
+
+    def handle(self, frame):
+        tag, self.state, msg2 = frame
+        if tag is not None:
+            self.handle_match(tag, self.state, msg2)
+            return
+
+        if self.state == 'QUEUED':
+            if self.verbose:
+                print msg2
+            return
+        if self.i == 0:
+            self.send(self.name_command())
+            if self.codec != 'pb2':
+                self.send('CODEC {}'.format(self.codec))
+            if self.binary:
+                self.send('BINARY {}'.format(framing.version))
+            self.send('MUX')
+        elif self.i == self.handshake:  # multiplexing
+            for _ in range(self.create):
+                self.send('CREATE num_players={}'.format(self.num_players))
+            for match_id in self.join:
+                self.send('JOIN {}'.format(match_id))
+        elif self.i > self.handshake:
+            raise MatchFailed(msg2)
+        self.i += 1
+
+    def start_match(self, match_id):
+        if match_id in self.matches:
+            self.send('@{} START'.format(match_id))
+
+    def match_ended(self, match_id, failed):
+        self.matches.pop(match_id, None)
+        self.ended += 1
+        self.failed += failed
+        if self.ended == self.expected:
+            self.finished = True
+
+    def handle_match(self, match_id, state, msg2):
+        match = self.matches.setdefault(match_id, MuxMatch())
+        tag = '@{} '.format(match_id)
+
+        if state == 'JOINED':
+            if match.state is None:
+                print "Joined {}".format(msg2)
+            match.state = state
+            self.later(1, self.start_match, match_id)
+        elif state == 'STARTED':
+            match.state = state
+            sett, match.player_id = self.serializer.deserialize_settings(msg2)
+            self.send(tag + ('TURN DELTA' if self.deltas else 'TURN'))
+        elif state == 'TURN':
+            try:
+                gs = self.decode_gamestate(match.gamestate, msg2)
+            except DeltaError:
+                self.pending.append(tag + 'KEYFRAME')
+                return
+            match.gamestate = gs
+            if self.verbose:
+                print "{}: running turn {}".format(match_id, gs.turn)
+            self.pending.append(tag + 'TURN ' + self.actions_str(
+                gs, match.player_id))
+        elif state == 'ENDED':
+            print "{}: game finished".format(match_id)
+            self.match_ended(match_id, False)
+        else:  # CONNECTED (join failed) or DISCONNECTED
+            print "{}: {}".format(match_id, msg2)
+            self.match_ended(match_id, True)
+
+
+class ClientLoop(object):
+    """Drives many MatchRunners over non-blocking sockets from one thread.
+
+        loop = ClientLoop()
+        loop.add(MatchRunner('bot.py', verbose=False), 'rg-match://host:port/')
+        loop.run()
+    """
+    def __init__(self):
+        self.runners = {}  # fileno -> runner
+        self.timers = []  # heap of (time, seq, f, args)
+        self._seq = itertools.count()
+
+    def add(self, runner, uri_str):
+        runner.connect(uri_str)
+        runner.socket.setblocking(0)
+        runner.loop = self
+        self.runners[runner.socket.fileno()] = runner
+
+    def remove(self, runner, error=None):
+        del self.runners[runner.socket.fileno()]
+        runner.disconnect()
+        self.runner_done(runner, error)
+
+    def runner_done(self, runner, error):
+        if error is not None:
+            print "{}: {}".format(runner.fname, error)
+
+    def call_later(self, delay, f, *args):
+        heapq.heappush(self.timers,
+                       (time.time() + delay, next(self._seq), f, args))
+
+    def run_timers(self):
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            _, _, f, args = heapq.heappop(self.timers)
+            f(*args)
+
+    def run(self):
+        while self.runners:
+            timeout = None
+            if self.timers:
+                timeout = max(0, self.timers[0][0] - time.time())
+            writers = [fd for fd, runner in self.runners.items()
+                       if runner.outbuf]
+            readable, writable, _ = select.select(
+                list(self.runners), writers, [], timeout)
+
+            for fd in writable:
+                runner = self.runners[fd]
+                try:
+                    runner.flush()
+                except ConnectionClosed as e:
+                    self.remove(runner, e)
+
+            for fd in readable:
+                runner = self.runners.get(fd)
+                if runner is None:  # removed while writing
+                    continue
+                try:
+                    runner.read()
+                    runner.handle_frames()
+                except (ConnectionClosed, ProtocolError, MatchFailed) as e:
+                    self.remove(runner, e if not runner.finished else None)
+
+            self.run_timers()
+            for runner in self.runners.values():
+                if runner.finished and not runner.outbuf:
+                    self.remove(runner)
+
+
 
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser(description="Run a robotgame match over the network")
     parser.add_argument('uri', type=str, help="URI of match (join) or server (create)")
     parser.add_argument('robot', type=str, help="Filename of the robot to use")
+    parser.add_argument('--no-delta', action='store_true',
+                        help="Receive full gamestates instead of deltas")
+    parser.add_argument('--codec', choices=sorted(codecs), default='pb2',
+                        help="Encoding of the gamestates sent by the server")
+    parser.add_argument('--queue', action='store_true',
+                        help="Let the server's matchmaker find an opponent")
+    parser.add_argument('--compress', action='store_true',
+                        help="Ask the server to compress larger frames")
+    parser.add_argument('--binary', action='store_true',
+                        help="Use binary frames instead of text")
+    parser.add_argument('--boards', action='store_true',
+                        help="Keep the turn history as numpy Boards")
+    parser.add_argument('--mux', type=int, metavar='N',
+                        help="Create N matches (or join the match of the "
+                             "URI) and play them over one connection")
     args = parser.parse_args()
+    if args.boards:
+        import board
+        if board.numpy is None:
+            parser.error("--boards needs numpy")
         
-    mr = MatchRunner(fname=args.robot)
+    if args.mux is not None:
+        match_id = urlparse(args.uri).path[1:]
+        mr = MuxRunner(fname=args.robot, deltas=not args.no_delta,
+                       create=0 if match_id else args.mux,
+                       join=[match_id] if match_id else [], verbose=False,
+                       codec=args.codec, compress=args.compress,
+                       binary=args.binary)
+        mr.run(args.uri)
+        sys.exit(1 if mr.failed else 0)
+
+    mr = MatchRunner(fname=args.robot, deltas=not args.no_delta,
+                     codec=args.codec, queue=args.queue,
+                     compress=args.compress, binary=args.binary,
+                     boards=args.boards)
     mr.join_or_create_match(args.uri)
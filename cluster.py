@@ -0,0 +1,228 @@
+#cluster.py
+# several worker processes sharing one listening port. each worker owns the
+# matches it created, replicates a summary of them to its peers (for LIST
+# and PLAYERS) and hands client connections off to the worker owning the
+# match they want to JOIN.
+
+import os
+import sys
+import json
+import base64
+import socket
+import tempfile
+import itertools
+
+from zope.interface import implementer
+from twisted.internet import reactor
+from twisted.internet.interfaces import IFileDescriptorReceiver
+from twisted.internet.protocol import (Factory, ProcessProtocol,
+                                       ReconnectingClientFactory)
+from twisted.protocols.basic import NetstringReceiver
+
+import log
+import registry
+
+
+worker_index = None  # None if not running clustered
+num_workers = 1
+
+# match_id -> summary of a match owned by a peer
+remote_matches = registry.MatchRegistry()
+_sources = {}  # match_id -> PeerProtocol it was published on
+peers = {}  # worker index -> PeerProtocol
+
+_player_factory = None
+_summaries = None  # callable returning summaries of the local matches
+_handoffs = {}  # token -> player waiting for the owner to adopt it
+_tokens = itertools.count()
+
+
+def socket_path(port, index):
+    return os.path.join(tempfile.gettempdir(),
+                        'rgmatch-{}-{}.sock'.format(port, index))
+
+
+@implementer(IFileDescriptorReceiver)
+class PeerProtocol(NetstringReceiver):
+    MAX_LENGTH = 1 << 20
+
+    def connectionMade(self):
+        self.fds = []
+        self.peer = self.factory.peer
+        if self.peer is not None:  # outgoing link, announce our matches
+            peers[self.peer] = self
+            for summary in _summaries():
+                self.send(op='match', match=summary)
+
+    def connectionLost(self, reason):
+        if self.peer is not None and peers.get(self.peer) is self:
+            del peers[self.peer]
+        # the matches of a peer are gone with its link
+        for match_id, link in _sources.items():
+            if link is self:
+                del _sources[match_id]
+                remote_matches.remove(match_id)
+        for fd in self.fds:
+            os.close(fd)
+
+    def send(self, **msg):
+        self.sendString(json.dumps(msg))
+
+    def fileDescriptorReceived(self, fd):
+        self.fds.append(fd)
+
+    def stringReceived(self, data):
+        msg = json.loads(data)
+        op = msg['op']
+        if op == 'match':
+            summary = msg['match']
+            remote_matches.add(summary['id'], summary, summary['status'])
+            _sources[summary['id']] = self
+        elif op == 'remove':
+            remote_matches.remove(msg['id'])
+            _sources.pop(msg['id'], None)
+        elif op == 'handoff':
+            fd = self.fds.pop(0)
+            try:
+                adopt(fd, msg['player'], str(msg['command']),
+                      base64.b64decode(msg.get('data', "")))
+            finally:
+                os.close(fd)
+            self.send(op='ack', token=msg['token'])
+        elif op == 'ack':
+            player = _handoffs.pop(msg['token'], None)
+            if player is not None:
+                player.handed_off()
+
+
+class PeerFactory(Factory):
+    protocol = PeerProtocol
+    peer = None
+
+
+class PeerClientFactory(ReconnectingClientFactory):
+    protocol = PeerProtocol
+    maxDelay = 1.0
+    initialDelay = 0.1
+
+    def __init__(self, peer):
+        self.peer = peer
+
+    def buildProtocol(self, addr):
+        self.resetDelay()
+        return ReconnectingClientFactory.buildProtocol(self, addr)
+
+
+class _AdoptionFactory(Factory):
+    def __init__(self, factory, player_info, command, data):
+        self.factory = factory
+        self.player_info = player_info
+        self.command = command
+        self.data = data
+
+    def buildProtocol(self, addr):
+        player = self.factory.buildProtocol(addr)
+        player.adopted = (self.player_info, self.command, self.data)
+        return player
+
+
+def adopt(fd, player_info, command, data):
+    reactor.adoptStreamConnection(
+        fd, socket.AF_INET,
+        _AdoptionFactory(_player_factory, player_info, command, data))
+
+
+def handoff(player, owner, command):
+    """Hand the connection of `player` off to worker `owner`, which replays
+    `command` on it. Returns False if the owner is not reachable."""
+    try:
+        link = peers[owner]
+    except KeyError:
+        return False
+
+    token = next(_tokens)
+    _handoffs[token] = player
+    player.transport.stopReading()
+    link.transport.sendFileDescriptor(player.transport.fileno())
+    link.send(op='handoff', token=token, player=player.handoff_info(),
+              command=command, data=base64.b64encode(player.unconsumed()))
+    player.handing_off()
+    return True
+
+
+def detach(transport):
+    """Close our copy of a handed off connection's socket without shutting
+    the connection down: its descriptor is pointed at an unconnected socket
+    before the transport closes it."""
+    placeholder = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    os.dup2(placeholder.fileno(), transport.fileno())
+    placeholder.close()
+    transport.loseConnection()
+
+
+def publish(summary):
+    for link in peers.values():
+        link.send(op='match', match=summary)
+
+
+def retract(match_id):
+    for link in peers.values():
+        link.send(op='remove', id=match_id)
+
+
+def start(index, workers, port, factory, summaries):
+    global worker_index, num_workers, _player_factory, _summaries
+    worker_index = index
+    num_workers = workers
+    _player_factory = factory
+    _summaries = summaries
+
+    path = socket_path(port, index)
+    if os.path.exists(path):
+        os.unlink(path)
+    reactor.listenUNIX(path, PeerFactory())
+    for peer in range(workers):
+        if peer != index:
+            reactor.connectUNIX(socket_path(port, peer),
+                                PeerClientFactory(peer))
+
+
+class WorkerProcess(ProcessProtocol):
+    def __init__(self, index, workers):
+        self.index = index
+        self.workers = workers
+
+    def processEnded(self, reason):
+        log.lifecycle.info("Worker %s exited: %s",
+                           self.index, reason.getErrorMessage())
+        self.workers.remove(self)
+        if not self.workers and reactor.running:
+            reactor.stop()
+
+
+def launch(workers, port, argv):
+    """Listen on `port` and spawn `workers` server processes sharing it."""
+    skt = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    skt.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    skt.bind(('', port))
+    skt.listen(50)
+    skt.setblocking(False)
+    fd = skt.fileno()
+
+    processes = []
+    for index in range(workers):
+        process = WorkerProcess(index, processes)
+        processes.append(process)
+        args = [sys.executable] + argv + [
+            '--worker', str(index), '--listen-fd', str(fd)]
+        reactor.spawnProcess(process, sys.executable, args, env=os.environ,
+                             childFDs={0: 0, 1: 1, 2: 2, fd: fd})
+
+    def stop_workers():
+        for process in processes:
+            try:
+                process.transport.signalProcess('TERM')
+            except Exception:
+                pass
+    reactor.addSystemEventTrigger('before', 'shutdown', stop_workers)
+    return skt
@@ -0,0 +1,96 @@
+#compression.py
+# optional compression of the frames sent to a client, negotiated with
+# NAME <name> compress=zlib. every frame is compressed on its own against
+# a preset dictionary of typical Settings and State payloads, so small
+# frames compress well too. python 2's zlib has no zdict, instead the
+# dictionary is deflated once into a primed (de)compressor that is copied
+# for every frame: a frame is the raw deflate data continuing that stream,
+# after a sync flush whose empty stored block (00 00 ff ff) is left out.
+#
+#   compressed frame: MARKER, deflate data
+
+import zlib
+
+import match_pb2
+
+methods = ("zlib",)
+MARKER = "\x00"  # text frames never start with it
+_sync_tail = "\x00\x00\xff\xff"
+level = 6
+
+
+def build_dictionary(board_size=19):
+    # the most common strings go last, closer matches are cheaper
+    sett = match_pb2.Settings(player_id=0)
+    sett.map.board_size = board_size
+    for x in range(board_size):
+        for y in range(board_size):
+            sett.map.obstacle_tiles.add(x=x, y=y)
+    sett.spawn_period = 10
+    sett.num_players = 2
+    sett.spawn_amount = 5
+    sett.turns = 100
+
+    delta = match_pb2.StateDelta(turn=2, base_turn=1)
+    state = match_pb2.State(turn=1)
+    for i in range(board_size * board_size):
+        x, y = divmod(i, board_size)
+        bot = state.bots.add(id=i + 1, player_id=i % 2, hp=50 - i % 50)
+        bot.location.x, bot.location.y = x, y
+        change = delta.changed.add(id=i + 1, hp=50 - i % 50)
+        change.location.x, change.location.y = x, y
+    return ("STARTED " + sett.SerializePartialToString() +
+            "ENDED TURN " + delta.SerializeToString() +
+            "TURN " + state.SerializeToString())
+
+
+dictionary = build_dictionary()
+
+
+_primed = {}  # dictionary -> (compressor, decompressor) fed the dictionary
+
+
+def primed(dictionary):
+    try:
+        return _primed[dictionary]
+    except KeyError:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        prefix = compressor.compress(dictionary)
+        prefix += compressor.flush(zlib.Z_SYNC_FLUSH)
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        decompressor.decompress(prefix)
+        _primed[dictionary] = compressor, decompressor
+        return compressor, decompressor
+
+
+class Deflater(object):
+    """Compresses frames, the same for every connection."""
+    def __init__(self, dictionary=dictionary):
+        self._primed, _ = primed(dictionary)
+        self._last = (None, None)  # spectators are sent the same frame
+
+    def compress(self, parts):
+        """Compress the frame made of the strings `parts`."""
+        if self._last[0] == parts:
+            return self._last[1]
+        compressor = self._primed.copy()
+        data = "".join([compressor.compress(part) for part in parts])
+        data += compressor.flush(zlib.Z_SYNC_FLUSH)
+        data = MARKER + data[:-len(_sync_tail)]
+        self._last = (parts, data)
+        return data
+
+
+class Inflater(object):
+    def __init__(self, dictionary=dictionary):
+        _, self._primed = primed(dictionary)
+
+    def decompress(self, frame):
+        """`frame` as received, frames without MARKER were sent raw."""
+        if not frame.startswith(MARKER):
+            return frame
+        decompressor = self._primed.copy()
+        return decompressor.decompress(frame[1:] + _sync_tail)
+
+
+deflater = Deflater()
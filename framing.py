@@ -0,0 +1,69 @@
+#framing.py
+# binary frames, negotiated with BINARY 1 instead of "<state> <data>" text
+# frames. every netstring holds one frame:
+#
+#   message:         MESSAGE, state, payload
+#   tagged message:  TAGGED, state, tag length (u8), tag, payload (MUX)
+#   compressed:      compression.MARKER, deflate data of a frame
+#
+# state is the index of the connection state in `states`. frames are
+# written as a list of parts (header, payload) so the payload is never
+# copied into a new string, and parsed with memoryview slicing. text frames
+# never start with one of these bytes.
+
+version = 1
+MESSAGE = 1
+TAGGED = 2
+kinds = (MESSAGE, TAGGED)
+states = ("CONNECTED", "QUEUED", "SEARCHING", "JOINED", "STARTED", "TURN",
+          "ENDED", "DISCONNECTED", "WATCHING")
+_state_bytes = dict((state, chr(i)) for i, state in enumerate(states))
+
+
+class FramingError(Exception):
+    pass
+
+
+def header(state, tag=None):
+    if tag is None:
+        return chr(MESSAGE) + _state_bytes[state]
+    return chr(TAGGED) + _state_bytes[state] + chr(len(tag)) + tag
+
+
+def is_binary(frame):
+    return frame[:1] in (chr(MESSAGE), chr(TAGGED))
+
+
+def parse(data, start=0, end=None):
+    """(tag, state, payload) of the binary frame in data[start:end], a str
+    or bytearray. tag is None for untagged frames, only the payload and tag
+    are copied."""
+    view = memoryview(data)
+    if end is None:
+        end = len(data)
+    try:
+        kind = ord(view[start])
+        state = states[ord(view[start + 1])]
+        pos = start + 2
+        tag = None
+        if kind == TAGGED:
+            length = ord(view[pos])
+            tag = view[pos + 1:pos + 1 + length].tobytes()
+            pos += 1 + length
+        elif kind != MESSAGE:
+            raise FramingError("Unknown frame type {}".format(kind))
+    except IndexError:
+        raise FramingError("Malformed frame")
+    if pos > end:
+        raise FramingError("Truncated frame")
+    return tag, state, view[pos:end].tobytes()
+
+
+def parse_text(frame):
+    """(tag, state, payload) of a text frame."""
+    tag = None
+    if frame.startswith("@"):
+        tag, _, frame = frame.partition(" ")
+        tag = tag[1:]
+    state, _, payload = frame.partition(" ")
+    return tag, state, payload
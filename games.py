@@ -0,0 +1,22 @@
+#games.py
+# how the server creates, plays and ends rgkit Games. no Twisted, so that
+# tournament.py and pool processes can use it without a reactor.
+
+from rgkit.game import Game, settings
+import maps
+
+
+def new_game(players, map_name=None):
+    """A Game as played by the server, `players` provide the actions."""
+    maps.apply(settings, map_name)
+    return Game(players, record_actions=False, record_history=False,
+                symmetric=True)
+
+
+def game_over(game):
+    return game._state.turn > settings.max_turns
+
+
+def run_turn(game):
+    game.run_turn()
+    return game._state
@@ -0,0 +1,320 @@
+#!/usr/bin/env python2
+#loadtest.py
+# drives many simulated players against a server and reports throughput
+# and turn round-trip latency. every match is played by two connections,
+# one CREATEs it and the other JOINs. with --loopback the server runs in
+# this process and the players connect to it through loopback.py, leaving
+# only the server's own work to measure (and profile).
+
+import time
+import random
+
+from twisted.internet import reactor, defer
+from twisted.internet.endpoints import TCP4ClientEndpoint, connectProtocol
+from twisted.protocols.basic import NetstringReceiver
+
+from rgkit import rg
+from serialization import codecs, DeltaError
+import compression
+import framing
+
+
+# action strategies: (gamestate, player_id) -> actions for own robots
+def guard(gs, player_id):
+    return {loc: ('guard',) for loc, bot in gs.robots.items()
+            if bot['player_id'] == player_id}
+
+
+def random_walk(gs, player_id):
+    actions = {}
+    for loc, bot in gs.robots.items():
+        if bot['player_id'] != player_id:
+            continue
+        around = rg.locs_around(loc, filter_out=('invalid', 'obstacle'))
+        action = random.choice(('guard', 'move', 'attack'))
+        if action == 'guard' or not around:
+            actions[loc] = ('guard',)
+        else:
+            actions[loc] = (action, random.choice(around))
+    return actions
+
+
+def attack(gs, player_id):
+    actions = {}
+    for loc, bot in gs.robots.items():
+        if bot['player_id'] != player_id:
+            continue
+        enemies = [l for l in rg.locs_around(loc)
+                   if l in gs.robots and
+                   gs.robots[l]['player_id'] != player_id]
+        if enemies:
+            actions[loc] = ('attack', enemies[0])
+        elif loc != rg.CENTER_POINT:
+            actions[loc] = ('move', rg.toward(loc, rg.CENTER_POINT))
+        else:
+            actions[loc] = ('guard',)
+    return actions
+
+
+strategies = {'guard': guard, 'random': random_walk, 'attack': attack}
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return float('nan')
+    i = min(len(sorted_values) - 1, int(p / 100. * len(sorted_values)))
+    return sorted_values[i]
+
+
+class LoadError(Exception):
+    pass
+
+
+class SimPlayer(NetstringReceiver):
+    MAX_LENGTH = 1 << 20
+
+    def __init__(self, stats, match_id, strategy, create_options=None,
+                 codec='pb2', compress=False, binary=False):
+        """`match_id` is a Deferred firing with the id to JOIN, or None to
+        CREATE a match with `create_options`, firing `self.created`."""
+        self.stats = stats
+        self.match_id = match_id
+        self.strategy = strategy
+        self.create_options = create_options
+        self.codec = codec
+        self.serializer = codecs[codec]
+        self.inflater = compression.Inflater() if compress else None
+        self.binary = binary
+        self.replies = 0  # to NAME, CODEC and BINARY
+        self.handshake = 1 + (codec != 'pb2') + binary
+        self.created = defer.Deferred()
+        self.done = defer.Deferred()
+        self.gamestate = None
+        self.player_id = None
+        self.sent_at = None
+        self.turns = 0
+
+    def send(self, data):
+        self.sendString(data)
+
+    def fail(self, reason):
+        if self.match_id is None and not self.created.called:
+            self.created.errback(LoadError("Match was not created"))
+        if not self.done.called:
+            self.done.errback(LoadError(reason))
+        if self.transport is not None:
+            self.transport.loseConnection()
+
+    def connectionLost(self, reason):
+        self.fail("Connection lost in turn {}".format(
+            self.gamestate.turn if self.gamestate else None))
+
+    def stringReceived(self, data):
+        if self.inflater is not None:
+            self.stats.wire_bytes += len(data)
+            t = time.time()
+            data = self.inflater.decompress(data)
+            self.stats.inflate_seconds += time.time() - t
+            self.stats.frame_bytes += len(data)
+        if framing.is_binary(data):
+            _, state, msg = framing.parse(data)
+        else:
+            state, _, msg = data.partition(' ')
+        if state == 'QUEUED':
+            pass  # admitted with a Welcome later
+        elif state == 'CONNECTED':
+            if msg.startswith('Welcome'):
+                self.send('NAME loadtest compress=zlib' if self.inflater
+                          else 'NAME loadtest')
+                if self.codec != 'pb2':
+                    self.send('CODEC ' + self.codec)
+                if self.binary:
+                    self.send('BINARY {}'.format(framing.version))
+            elif msg.startswith(('Hello', 'Codec', 'Binary')):
+                self.replies += 1
+                if self.replies < self.handshake:
+                    return
+                if self.match_id is None:
+                    self.send('CREATE ' + ' '.join(
+                        '{}={}'.format(k, v)
+                        for k, v in self.create_options.items()))
+                else:
+                    self.match_id.addCallbacks(
+                        lambda match_id: self.send('JOIN ' + match_id),
+                        lambda failure: self.fail(failure.getErrorMessage()))
+            else:
+                self.fail(msg)
+        elif state == 'JOINED':
+            if self.match_id is None and not self.created.called:
+                self.created.callback(msg.split(' ')[0].split('/')[-1])
+            # retried until the match is full
+            reactor.callLater(0.01 if self.match_id is None else 0,
+                              self.send, 'START')
+        elif state == 'STARTED':
+            sett, self.player_id = self.serializer.deserialize_settings(msg)
+            self.send('TURN DELTA')
+        elif state in ('TURN', 'ENDED'):
+            try:
+                gs = self.serializer.apply_delta(self.gamestate, msg)
+            except DeltaError:
+                self.send('KEYFRAME')
+                return
+            now = time.time()
+            if self.sent_at is not None:
+                self.stats.rtts.append(now - self.sent_at)
+                self.sent_at = None
+            self.gamestate = gs
+            self.turns += 1
+            if state == 'ENDED':
+                self.done.callback(self.turns)
+                return
+
+            actions = self.strategy(gs, self.player_id)
+            actions_str = self.serializer.serialize_actions(
+                actions, gs.robots, turn=gs.turn)
+            self.sent_at = time.time()
+            self.send('TURN {}'.format(actions_str))
+        else:
+            self.fail(data)
+
+
+class Stats(object):
+    def __init__(self):
+        self.rtts = []
+        self.matches = 0
+        self.failed = 0
+        self.turns = 0
+        self.wire_bytes = 0  # of compressed connections, as received
+        self.frame_bytes = 0  # and decompressed
+        self.inflate_seconds = 0.0
+        self.started = time.time()
+
+    def report(self):
+        elapsed = time.time() - self.started
+        rtts = sorted(self.rtts)
+        print "{} matches ({} failed) in {:.2f} s".format(
+            self.matches, self.failed, elapsed)
+        print "{:.2f} matches/s, {:.1f} turns/s".format(
+            self.matches / elapsed, self.turns / elapsed)
+        print "turn round trip: p50 {:.2f} ms, p99 {:.2f} ms, " \
+              "p999 {:.2f} ms ({} samples)".format(
+                  1000 * percentile(rtts, 50), 1000 * percentile(rtts, 99),
+                  1000 * percentile(rtts, 99.9), len(rtts))
+        if self.frame_bytes:
+            print "compression: {} bytes received for {} ({:.0f}% saved), " \
+                  "{:.1f} ms decompressing".format(
+                      self.wire_bytes, self.frame_bytes,
+                      100. * (self.frame_bytes - self.wire_bytes) /
+                      self.frame_bytes, 1000 * self.inflate_seconds)
+
+
+class LoadTest(object):
+    def __init__(self, connect, matches, concurrency, strategy,
+                 create_options, codec='pb2', compress=False, binary=False):
+        """`connect(protocol)` connects a SimPlayer to the server and
+        returns a Deferred."""
+        self.connect = connect
+        self.remaining = matches
+        self.concurrency = concurrency
+        self.strategy = strategy
+        self.create_options = create_options
+        self.codec = codec
+        self.compress = compress
+        self.binary = binary
+        self.stats = Stats()
+        self.finished = defer.Deferred()
+        self.running = 0
+
+    def start(self):
+        for _ in range(min(self.concurrency, self.remaining)):
+            self.run_match()
+        return self.finished
+
+    def run_match(self):
+        self.remaining -= 1
+        self.running += 1
+
+        creator = SimPlayer(self.stats, None, self.strategy,
+                            self.create_options, self.codec, self.compress,
+                            self.binary)
+        joiner = SimPlayer(self.stats, creator.created, self.strategy,
+                           codec=self.codec, compress=self.compress,
+                           binary=self.binary)
+        for player in (creator, joiner):
+            self.connect(player).addErrback(
+                lambda failure, player=player:
+                    player.fail(failure.getErrorMessage()))
+
+        d = defer.gatherResults([creator.done, joiner.done],
+                                consumeErrors=True)
+        d.addCallbacks(self.match_done, self.match_failed)
+        d.addBoth(self.next_match)
+
+    def match_done(self, turns):
+        self.stats.matches += 1
+        self.stats.turns += turns[0]
+
+    def match_failed(self, failure):
+        self.stats.failed += 1
+        print "Match failed:", failure.value.subFailure.getErrorMessage()
+
+    def next_match(self, _):
+        self.running -= 1
+        if self.remaining > 0:
+            self.run_match()
+        elif self.running == 0:
+            self.finished.callback(self.stats)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Play many simulated matches against a server")
+    parser.add_argument('host', type=str, nargs='?')
+    parser.add_argument('port', type=int, nargs='?')
+    parser.add_argument('--loopback', action='store_true',
+                        help="Run the server in this process and connect "
+                             "to it without sockets")
+    parser.add_argument('--matches', type=int, default=100,
+                        help="Total number of matches to play")
+    parser.add_argument('--concurrency', type=int, default=10,
+                        help="Matches played at the same time")
+    parser.add_argument('--strategy', choices=sorted(strategies),
+                        default='random')
+    parser.add_argument('--codec', choices=sorted(codecs), default='pb2',
+                        help="Gamestate encoding requested by the players")
+    parser.add_argument('--compress', action='store_true',
+                        help="Have the server compress larger frames")
+    parser.add_argument('--binary', action='store_true',
+                        help="Use binary frames instead of text")
+    parser.add_argument('--turn-ms', type=int,
+                        help="Per-turn deadline of the created matches")
+    args = parser.parse_args()
+
+    if args.loopback:
+        import server
+        import loopback
+        import log
+        log.configure("all=warning")  # the server's lifecycle logging
+        factory = server.PlayerFactory(max_connections=2 * args.concurrency)
+
+        def connect(player):
+            return loopback.connect(factory, player)
+    elif args.port is None:
+        parser.error("host and port are required without --loopback")
+    else:
+        def connect(player):
+            endpoint = TCP4ClientEndpoint(reactor, args.host, args.port)
+            return connectProtocol(endpoint, player)
+
+    create_options = {'num_players': 2}
+    if args.turn_ms is not None:
+        create_options['turn_ms'] = args.turn_ms
+
+    test = LoadTest(connect, args.matches, args.concurrency,
+                    strategies[args.strategy], create_options, args.codec,
+                    args.compress, args.binary)
+    d = test.start()
+    d.addCallback(lambda stats: stats.report())
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
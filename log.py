@@ -0,0 +1,140 @@
+#log.py
+# leveled logging with per-category toggles and sampling. messages are
+# formatted and written by a background thread, so logging calls only
+# queue their arguments. disabled levels cost a single attribute check:
+#
+#   if log.wire.debug_on:
+#       log.wire.debug("<< %s: %r", peer, data)
+
+import sys
+import time
+import atexit
+import threading
+import itertools
+import Queue
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+OFF = 100
+
+level_names = {'debug': DEBUG, 'info': INFO, 'warning': WARNING,
+               'error': ERROR, 'off': OFF}
+_names = {DEBUG: 'DEBUG', INFO: 'INFO', WARNING: 'WARNING', ERROR: 'ERROR'}
+
+
+class _Writer(object):
+    def __init__(self, stream):
+        self.stream = stream
+        self.queue = Queue.Queue()
+        self.thread = None
+
+    def put(self, record):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="log")
+            self.thread.daemon = True
+            self.thread.start()
+        self.queue.put(record)
+
+    def run(self):
+        while True:
+            records = [self.queue.get()]
+            try:
+                while True:
+                    records.append(self.queue.get_nowait())
+            except Queue.Empty:
+                pass
+
+            lines = []
+            stop = False
+            for record in records:
+                if record is None:
+                    stop = True
+                    continue
+                t, category, level, fmt, args = record
+                try:
+                    msg = fmt % args if args else fmt
+                except Exception as e:
+                    msg = "{!r} {!r} ({})".format(fmt, args, e)
+                lines.append("{:.3f} {} {}: {}\n".format(
+                    t, category, _names.get(level, level), msg))
+            self.stream.write(''.join(lines))
+            self.stream.flush()
+            if stop:
+                break
+
+    def flush(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+
+_writer = _Writer(sys.stdout)
+atexit.register(_writer.flush)
+
+
+class Category(object):
+    def __init__(self, name, level=INFO, sample=1):
+        self.name = name
+        self.set_level(level, sample)
+
+    def set_level(self, level, sample=1):
+        """Log messages at or above `level`, and only every `sample`th
+        of them."""
+        self.level = level
+        self.sample = sample
+        self._counter = itertools.count()
+        self.debug_on = level <= DEBUG
+        self.info_on = level <= INFO
+
+    def log(self, level, fmt, *args):
+        if level < self.level:
+            return
+        if self.sample > 1 and next(self._counter) % self.sample:
+            return
+        _writer.put((time.time(), self.name, level, fmt, args))
+
+    def debug(self, fmt, *args):
+        if self.debug_on:
+            self.log(DEBUG, fmt, *args)
+
+    def info(self, fmt, *args):
+        if self.info_on:
+            self.log(INFO, fmt, *args)
+
+    def warning(self, fmt, *args):
+        self.log(WARNING, fmt, *args)
+
+    def error(self, fmt, *args):
+        self.log(ERROR, fmt, *args)
+
+
+wire = Category('wire')  # every message sent and received
+turns = Category('turns')  # actions and turn resolution
+lifecycle = Category('lifecycle')  # connections, matches, workers
+
+categories = {c.name: c for c in (wire, turns, lifecycle)}
+
+
+def configure(spec):
+    """Apply a `category=level[/sample]` spec, e.g. "wire=debug/100".
+    Category "all" sets every category."""
+    name, _, setting = spec.partition('=')
+    level, _, sample = setting.partition('/')
+    try:
+        level = level_names[level.lower()]
+        sample = int(sample) if sample else 1
+        if name == 'all':
+            targets = categories.values()
+        else:
+            targets = [categories[name]]
+    except (KeyError, ValueError):
+        raise ValueError("Invalid log setting: {}".format(spec))
+    for category in targets:
+        category.set_level(level, sample)
+
+
+def flush():
+    _writer.flush()
@@ -0,0 +1,152 @@
+#loopback.py
+# in-process connections between client protocols and server Players, no
+# sockets. bytes written on one end are handed to the other protocol's
+# dataReceived by a callLater(0), in a later reactor iteration than the
+# write, so timers and other connections run in between. the server still
+# runs its netstring parsing and stringReceived state machine unchanged.
+#
+#   factory = server.PlayerFactory(max_connections=1000)
+#   loopback.connect(factory, loadtest.SimPlayer(...))
+
+import itertools
+
+from twisted.internet import reactor, defer, error
+from twisted.internet.address import IPv4Address
+from twisted.internet.interfaces import ITransport
+from twisted.python import failure
+from zope.interface import implementer
+
+_ports = itertools.count(1)
+
+
+class Pump(object):
+    """Delivers the data queued on loopback transports. Data written while
+    delivering waits for the next call, so a match advances one exchange per
+    reactor iteration like over TCP."""
+    def __init__(self):
+        self.pending = set()  # transports with data or a close to deliver
+        self._call = None
+
+    def schedule(self, transport):
+        self.pending.add(transport)
+        if self._call is None:
+            self._call = reactor.callLater(0, self.run)
+
+    def run(self):
+        self._call = None
+        pending, self.pending = self.pending, set()
+        for transport in pending:
+            transport.deliver()
+
+
+pump = Pump()
+
+
+@implementer(ITransport)
+class LoopbackTransport(object):
+    """One end of a loopback connection. Implements the parts of Twisted's
+    TCP transport used by Player: writes past `bufferSize` pause the
+    registered producer until they were delivered, pauseProducing stops
+    the other end's data from being delivered."""
+    bufferSize = 64 * 1024
+
+    def __init__(self, host, peer):
+        self.host = host
+        self.peer = peer
+        self.protocol = None
+        self.other = None  # transport of the other end
+        self.queued = []  # written, not delivered yet
+        self.queued_bytes = 0
+        self.producer = None
+        self.producer_paused = False
+        self.reading = True
+        self.connected = True
+        self.disconnecting = False
+
+    def write(self, data):
+        if self.disconnecting or not data:
+            return
+        self.queued.append(data)
+        self.queued_bytes += len(data)
+        pump.schedule(self)
+        if (self.producer is not None and not self.producer_paused and
+                self.queued_bytes > self.bufferSize):
+            self.producer_paused = True
+            self.producer.pauseProducing()
+
+    def writeSequence(self, data):
+        self.write("".join(data))
+
+    def deliver(self):
+        if not self.connected:
+            return
+        if self.queued and self.other.reading:
+            data = "".join(self.queued)
+            self.queued = []
+            self.queued_bytes = 0
+            self.other.protocol.dataReceived(data)
+            if self.producer_paused:
+                self.producer_paused = False
+                self.producer.resumeProducing()
+        if self.disconnecting and not self.queued:
+            self.connectionLost()
+
+    def connectionLost(self):
+        reason = failure.Failure(error.ConnectionDone())
+        for transport in (self, self.other):
+            if transport.connected:
+                transport.connected = False
+                transport.disconnecting = True
+                if transport.producer is not None:
+                    transport.producer.stopProducing()
+                transport.protocol.connectionLost(reason)
+
+    def loseConnection(self):
+        self.disconnecting = True
+        pump.schedule(self)
+
+    def abortConnection(self):
+        self.queued = []
+        self.queued_bytes = 0
+        self.loseConnection()
+
+    def getPeer(self):
+        return self.peer
+
+    def getHost(self):
+        return self.host
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    # reading from the other end
+    def pauseProducing(self):
+        self.reading = False
+
+    def resumeProducing(self):
+        self.reading = True
+        pump.schedule(self.other)
+
+    def stopProducing(self):
+        self.loseConnection()
+
+
+def connect(factory, protocol, host="127.0.0.1"):
+    """Connect the client `protocol` to a server protocol built by
+    `factory`. Returns a Deferred firing with `protocol`, like
+    twisted.internet.endpoints.connectProtocol."""
+    client_addr = IPv4Address('TCP', host, next(_ports))
+    server_addr = IPv4Address('TCP', host, 0)
+    server = factory.buildProtocol(client_addr)
+    server_transport = LoopbackTransport(server_addr, client_addr)
+    client_transport = LoopbackTransport(client_addr, server_addr)
+    server_transport.other = client_transport
+    client_transport.other = server_transport
+    server_transport.protocol = server
+    client_transport.protocol = protocol
+    server.makeConnection(server_transport)
+    protocol.makeConnection(client_transport)
+    return defer.succeed(protocol)
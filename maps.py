@@ -0,0 +1,141 @@
+#maps.py
+# map registry. maps are <name>.py files (rgkit's map format) in the map
+# directories, "default" falls back to rgkit's default map. a map is parsed
+# on first use and the result cached in marshal form, so later processes
+# skip the literal_eval. the cache is per user and only used if the
+# directory belongs to that user and nobody else can write to it.
+
+import os
+import ast
+import stat
+import marshal
+import hashlib
+import tempfile
+
+default_map = "default"
+map_dirs = []  # searched in order
+cache_dir = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser("~/.cache"),
+    "rgmatch-maps")
+
+_maps = {}  # name -> map data
+_applied = {}  # id(rgkit settings) -> name of the map applied to them
+
+
+class MapError(Exception):
+    pass
+
+
+def add_dir(path):
+    if not os.path.isdir(path):
+        raise MapError("{} is not a directory".format(path))
+    map_dirs.append(path)
+
+
+def names():
+    found = set([default_map])
+    for path in map_dirs:
+        found.update(f[:-3] for f in os.listdir(path) if f.endswith(".py"))
+    return sorted(found)
+
+
+def path(name):
+    if os.sep in name or name.startswith("."):
+        raise MapError("Invalid map name {}".format(name))
+    for map_dir in map_dirs:
+        filepath = os.path.join(map_dir, name + ".py")
+        if os.path.exists(filepath):
+            return filepath
+    if name == default_map:
+        from rgkit.run import Options
+        return Options().map_filepath
+    raise MapError("Map {} does not exist".format(name))
+
+
+def _private_cache_dir():
+    """cache_dir, created if missing, or None if it is not private to this
+    user."""
+    try:
+        os.makedirs(cache_dir, 0o700)
+    except OSError:
+        pass  # exists, or can't be created which lstat reports
+    try:
+        st = os.lstat(cache_dir)
+    except OSError:
+        return None
+    if (not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or
+            st.st_mode & 0o077):
+        return None
+    return cache_dir
+
+
+def _cache_path(directory, filepath):
+    st = os.stat(filepath)
+    key = "{}:{}:{}".format(os.path.abspath(filepath), st.st_mtime, st.st_size)
+    return os.path.join(directory, hashlib.sha1(key).hexdigest() + ".marshal")
+
+
+def _valid(map_data):
+    # rgkit maps: lists of (x, y) locations
+    if not isinstance(map_data, dict):
+        return False
+    for key in ('spawn', 'obstacle'):
+        locations = map_data.get(key)
+        if not isinstance(locations, list):
+            return False
+        for loc in locations:
+            if (not isinstance(loc, tuple) or len(loc) != 2 or
+                    not all(type(i) is int for i in loc)):
+                return False
+    return True
+
+
+def _parse(filepath):
+    directory = _private_cache_dir()
+    if directory is not None:
+        cache_path = _cache_path(directory, filepath)
+        try:
+            with open(cache_path, "rb") as f:
+                map_data = marshal.load(f)
+            if _valid(map_data):
+                return map_data
+        except (IOError, EOFError, ValueError, TypeError):
+            pass
+    with open(filepath) as f:
+        map_data = ast.literal_eval(f.read())
+    if directory is not None and _valid(map_data):
+        _write_cache(directory, cache_path, map_data)
+    return map_data
+
+
+def _write_cache(directory, cache_path, map_data):
+    try:
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=directory)
+    except OSError:
+        return  # not cached, parsed again next time
+    try:
+        with os.fdopen(fd, "wb") as f:
+            marshal.dump(map_data, f)
+        os.rename(tmp_path, cache_path)
+    except (OSError, IOError):
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+
+def load(name=None):
+    name = name or default_map
+    try:
+        return _maps[name]
+    except KeyError:
+        map_data = _maps[name] = _parse(path(name))
+        return map_data
+
+
+def apply(settings, name=None):
+    """Apply a map to rgkit settings, unless it already is."""
+    name = name or default_map
+    if _applied.get(id(settings)) != name:
+        settings.init_map(load(name))
+        _applied[id(settings)] = name
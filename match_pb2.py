@@ -19,7 +19,7 @@ _sym_db = _symbol_database.Default()
 DESCRIPTOR = _descriptor.FileDescriptor(
   name='match.proto',
   package='robotgame',
-  serialized_pb=_b('\n\x0bmatch.proto\x12\trobotgame\"\xf0\x02\n\x08Settings\x12\x11\n\tplayer_id\x18\x01 \x02(\x05\x12$\n\x03map\x18\x02 \x02(\x0b\x32\x17.robotgame.Settings.Map\x12\x12\n\x05turns\x18\x03 \x01(\x05:\x03\x31\x30\x30\x12\x16\n\x0bnum_players\x18\x04 \x01(\x05:\x01\x32\x12\x18\n\x0cspawn_period\x18\x05 \x01(\x05:\x02\x31\x30\x12\x17\n\x0cspawn_amount\x18\x06 \x01(\x05:\x01\x35\x12\x17\n\tsymmetric\x18\x07 \x01(\x08:\x04true\x1a\xb2\x01\n\x03Map\x12\x12\n\nboard_size\x18\x01 \x02(\x05\x12:\n\x0eobstacle_tiles\x18\x02 \x03(\x0b\x32\".robotgame.Settings.Map.Coordinate\x12\x37\n\x0bspawn_tiles\x18\x03 \x03(\x0b\x32\".robotgame.Settings.Map.Coordinate\x1a\"\n\nCoordinate\x12\t\n\x01x\x18\x01 \x02(\x05\x12\t\n\x01y\x18\x02 \x02(\x05\"\xa1\x01\n\x05State\x12\x0c\n\x04turn\x18\x01 \x02(\x05\x12\"\n\x04\x62ots\x18\x02 \x03(\x0b\x32\x14.robotgame.State.Bot\x1a\x66\n\x03\x42ot\x12\n\n\x02id\x18\x01 \x02(\x05\x12\x34\n\x08location\x18\x02 \x02(\x0b\x32\".robotgame.Settings.Map.Coordinate\x12\x11\n\tplayer_id\x18\x03 \x02(\x05\x12\n\n\x02hp\x18\x04 \x02(\x05\"\xed\x01\n\x07\x41\x63tions\x12\x0c\n\x04turn\x18\x01 \x02(\x05\x12*\n\x07\x61\x63tions\x18\x02 \x03(\x0b\x32\x19.robotgame.Actions.Action\x1a\xa7\x01\n\x06\x41\x63tion\x12\x0e\n\x06\x62ot_id\x18\x01 \x02(\x05\x12\x34\n\x08location\x18\x02 \x02(\x0b\x32\".robotgame.Settings.Map.Coordinate\x12#\n\x04type\x18\x03 \x02(\x0e\x32\x15.robotgame.ActionType\x12\x32\n\x06target\x18\x04 \x01(\x0b\x32\".robotgame.Settings.Map.Coordinate*:\n\nActionType\x12\t\n\x05GUARD\x10\x00\x12\x08\n\x04MOVE\x10\x01\x12\n\n\x06\x41TTACK\x10\x02\x12\x0b\n\x07SUICIDE\x10\x03\x32M\n\x14TurnExecutionService\x12\x35\n\rTurnExecution\x12\x12.robotgame.Actions\x1a\x10.robotgame.StateB\x02H\x01')
+  serialized_pb=_b('\n\x0bmatch.proto\x12\trobotgame\"\xf0\x02\n\x08Settings\x12\x11\n\tplayer_id\x18\x01 \x02(\x05\x12$\n\x03map\x18\x02 \x02(\x0b\x32\x17.robotgame.Settings.Map\x12\x12\n\x05turns\x18\x03 \x01(\x05:\x03\x31\x30\x30\x12\x16\n\x0bnum_players\x18\x04 \x01(\x05:\x01\x32\x12\x18\n\x0cspawn_period\x18\x05 \x01(\x05:\x02\x31\x30\x12\x17\n\x0cspawn_amount\x18\x06 \x01(\x05:\x01\x35\x12\x17\n\tsymmetric\x18\x07 \x01(\x08:\x04true\x1a\xb2\x01\n\x03Map\x12\x12\n\nboard_size\x18\x01 \x02(\x05\x12:\n\x0eobstacle_tiles\x18\x02 \x03(\x0b\x32\".robotgame.Settings.Map.Coordinate\x12\x37\n\x0bspawn_tiles\x18\x03 \x03(\x0b\x32\".robotgame.Settings.Map.Coordinate\x1a\"\n\nCoordinate\x12\t\n\x01x\x18\x01 \x02(\x05\x12\t\n\x01y\x18\x02 \x02(\x05\"\xa1\x01\n\x05State\x12\x0c\n\x04turn\x18\x01 \x02(\x05\x12\"\n\x04\x62ots\x18\x02 \x03(\x0b\x32\x14.robotgame.State.Bot\x1a\x66\n\x03\x42ot\x12\n\n\x02id\x18\x01 \x02(\x05\x12\x34\n\x08location\x18\x02 \x02(\x0b\x32\".robotgame.Settings.Map.Coordinate\x12\x11\n\tplayer_id\x18\x03 \x02(\x05\x12\n\n\x02hp\x18\x04 \x02(\x05\"\x85\x02\n\nStateDelta\x12\x0c\n\x04turn\x18\x01 \x02(\x05\x12\x11\n\tbase_turn\x18\x02 \x01(\x05\x12%\n\x07spawned\x18\x03 \x03(\x0b\x32\x14.robotgame.State.Bot\x12\x0f\n\x07removed\x18\x04 \x03(\x05\x12-\n\x07\x63hanged\x18\x05 \x03(\x0b\x32\x1c.robotgame.StateDelta.Change\x12\x17\n\x08keyframe\x18\x06 \x01(\x08:\x05\x66\x61lse\x1aV\n\x06\x43hange\x12\n\n\x02id\x18\x01 \x02(\x05\x12\x34\n\x08location\x18\x02 \x01(\x0b\x32\".robotgame.Settings.Map.Coordinate\x12\n\n\x02hp\x18\x03 \x01(\x05\"\xed\x01\n\x07\x41\x63tions\x12\x0c\n\x04turn\x18\x01 \x02(\x05\x12*\n\x07\x61\x63tions\x18\x02 \x03(\x0b\x32\x19.robotgame.Actions.Action\x1a\xa7\x01\n\x06\x41\x63tion\x12\x0e\n\x06\x62ot_id\x18\x01 \x02(\x05\x12\x34\n\x08location\x18\x02 \x02(\x0b\x32\".robotgame.Settings.Map.Coordinate\x12#\n\x04type\x18\x03 \x02(\x0e\x32\x15.robotgame.ActionType\x12\x32\n\x06target\x18\x04 \x01(\x0b\x32\".robotgame.Settings.Map.Coordinate*:\n\nActionType\x12\t\n\x05GUARD\x10\x00\x12\x08\n\x04MOVE\x10\x01\x12\n\n\x06\x41TTACK\x10\x02\x12\x0b\n\x07SUICIDE\x10\x03\x32M\n\x14TurnExecutionService\x12\x35\n\rTurnExecution\x12\x12.robotgame.Actions\x1a\x10.robotgame.StateB\x02H\x01')
 )
 _sym_db.RegisterFileDescriptor(DESCRIPTOR)
 
@@ -48,8 +48,8 @@ _ACTIONTYPE = _descriptor.EnumDescriptor(
   ],
   containing_type=None,
   options=None,
-  serialized_start=801,
-  serialized_end=859,
+  serialized_start=1065,
+  serialized_end=1123,
 )
 _sym_db.RegisterEnumDescriptor(_ACTIONTYPE)
 
@@ -299,6 +299,114 @@ _STATE = _descriptor.Descriptor(
 )
 
 
+_STATEDELTA_CHANGE = _descriptor.Descriptor(
+  name='Change',
+  full_name='robotgame.StateDelta.Change',
+  filename=None,
+  file=DESCRIPTOR,
+  containing_type=None,
+  fields=[
+    _descriptor.FieldDescriptor(
+      name='id', full_name='robotgame.StateDelta.Change.id', index=0,
+      number=1, type=5, cpp_type=1, label=2,
+      has_default_value=False, default_value=0,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+    _descriptor.FieldDescriptor(
+      name='location', full_name='robotgame.StateDelta.Change.location', index=1,
+      number=2, type=11, cpp_type=10, label=1,
+      has_default_value=False, default_value=None,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+    _descriptor.FieldDescriptor(
+      name='hp', full_name='robotgame.StateDelta.Change.hp', index=2,
+      number=3, type=5, cpp_type=1, label=1,
+      has_default_value=False, default_value=0,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+  ],
+  extensions=[
+  ],
+  nested_types=[],
+  enum_types=[
+  ],
+  options=None,
+  is_extendable=False,
+  extension_ranges=[],
+  oneofs=[
+  ],
+  serialized_start=737,
+  serialized_end=823,
+)
+
+_STATEDELTA = _descriptor.Descriptor(
+  name='StateDelta',
+  full_name='robotgame.StateDelta',
+  filename=None,
+  file=DESCRIPTOR,
+  containing_type=None,
+  fields=[
+    _descriptor.FieldDescriptor(
+      name='turn', full_name='robotgame.StateDelta.turn', index=0,
+      number=1, type=5, cpp_type=1, label=2,
+      has_default_value=False, default_value=0,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+    _descriptor.FieldDescriptor(
+      name='base_turn', full_name='robotgame.StateDelta.base_turn', index=1,
+      number=2, type=5, cpp_type=1, label=1,
+      has_default_value=False, default_value=0,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+    _descriptor.FieldDescriptor(
+      name='spawned', full_name='robotgame.StateDelta.spawned', index=2,
+      number=3, type=11, cpp_type=10, label=3,
+      has_default_value=False, default_value=[],
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+    _descriptor.FieldDescriptor(
+      name='removed', full_name='robotgame.StateDelta.removed', index=3,
+      number=4, type=5, cpp_type=1, label=3,
+      has_default_value=False, default_value=[],
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+    _descriptor.FieldDescriptor(
+      name='changed', full_name='robotgame.StateDelta.changed', index=4,
+      number=5, type=11, cpp_type=10, label=3,
+      has_default_value=False, default_value=[],
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+    _descriptor.FieldDescriptor(
+      name='keyframe', full_name='robotgame.StateDelta.keyframe', index=5,
+      number=6, type=8, cpp_type=7, label=1,
+      has_default_value=True, default_value=False,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+  ],
+  extensions=[
+  ],
+  nested_types=[_STATEDELTA_CHANGE, ],
+  enum_types=[
+  ],
+  options=None,
+  is_extendable=False,
+  extension_ranges=[],
+  oneofs=[
+  ],
+  serialized_start=562,
+  serialized_end=823,
+)
+
+
 _ACTIONS_ACTION = _descriptor.Descriptor(
   name='Action',
   full_name='robotgame.Actions.Action',
@@ -345,8 +453,8 @@ _ACTIONS_ACTION = _descriptor.Descriptor(
   extension_ranges=[],
   oneofs=[
   ],
-  serialized_start=632,
-  serialized_end=799,
+  serialized_start=896,
+  serialized_end=1063,
 )
 
 _ACTIONS = _descriptor.Descriptor(
@@ -381,8 +489,8 @@ _ACTIONS = _descriptor.Descriptor(
   extension_ranges=[],
   oneofs=[
   ],
-  serialized_start=562,
-  serialized_end=799,
+  serialized_start=826,
+  serialized_end=1063,
 )
 
 _SETTINGS_MAP_COORDINATE.containing_type = _SETTINGS_MAP
@@ -393,6 +501,10 @@ _SETTINGS.fields_by_name['map'].message_type = _SETTINGS_MAP
 _STATE_BOT.fields_by_name['location'].message_type = _SETTINGS_MAP_COORDINATE
 _STATE_BOT.containing_type = _STATE
 _STATE.fields_by_name['bots'].message_type = _STATE_BOT
+_STATEDELTA_CHANGE.fields_by_name['location'].message_type = _SETTINGS_MAP_COORDINATE
+_STATEDELTA_CHANGE.containing_type = _STATEDELTA
+_STATEDELTA.fields_by_name['spawned'].message_type = _STATE_BOT
+_STATEDELTA.fields_by_name['changed'].message_type = _STATEDELTA_CHANGE
 _ACTIONS_ACTION.fields_by_name['location'].message_type = _SETTINGS_MAP_COORDINATE
 _ACTIONS_ACTION.fields_by_name['type'].enum_type = _ACTIONTYPE
 _ACTIONS_ACTION.fields_by_name['target'].message_type = _SETTINGS_MAP_COORDINATE
@@ -400,6 +512,7 @@ _ACTIONS_ACTION.containing_type = _ACTIONS
 _ACTIONS.fields_by_name['actions'].message_type = _ACTIONS_ACTION
 DESCRIPTOR.message_types_by_name['Settings'] = _SETTINGS
 DESCRIPTOR.message_types_by_name['State'] = _STATE
+DESCRIPTOR.message_types_by_name['StateDelta'] = _STATEDELTA
 DESCRIPTOR.message_types_by_name['Actions'] = _ACTIONS
 DESCRIPTOR.enum_types_by_name['ActionType'] = _ACTIONTYPE
 
@@ -441,6 +554,21 @@ State = _reflection.GeneratedProtocolMessageType('State', (_message.Message,), d
 _sym_db.RegisterMessage(State)
 _sym_db.RegisterMessage(State.Bot)
 
+StateDelta = _reflection.GeneratedProtocolMessageType('StateDelta', (_message.Message,), dict(
+
+  Change = _reflection.GeneratedProtocolMessageType('Change', (_message.Message,), dict(
+    DESCRIPTOR = _STATEDELTA_CHANGE,
+    __module__ = 'match_pb2'
+    # @@protoc_insertion_point(class_scope:robotgame.StateDelta.Change)
+    ))
+  ,
+  DESCRIPTOR = _STATEDELTA,
+  __module__ = 'match_pb2'
+  # @@protoc_insertion_point(class_scope:robotgame.StateDelta)
+  ))
+_sym_db.RegisterMessage(StateDelta)
+_sym_db.RegisterMessage(StateDelta.Change)
+
 Actions = _reflection.GeneratedProtocolMessageType('Actions', (_message.Message,), dict(
 
   Action = _reflection.GeneratedProtocolMessageType('Action', (_message.Message,), dict(
@@ -0,0 +1,123 @@
+#matchmaking.py
+# automatic matchmaking for QUEUE. waiting players are kept sorted by rating,
+# so a new player only has to be compared with its two neighbours (bisect).
+# players are paired when their ratings are within both players' tolerance
+# windows, which widen the longer they wait; a periodic sweep pairs
+# neighbours whose windows have grown enough.
+
+import time
+import bisect
+import itertools
+
+from twisted.internet import task
+
+import metrics
+
+default_rating = 1500
+k_factor = 32
+ratings = {}  # player name -> Elo rating
+
+wait_seconds = metrics.Histogram(
+    "rg_matchmaking_wait_seconds", "Time players waited in the QUEUE")
+matches_made = metrics.Counter(
+    "rg_matchmaking_matches_total", "Matches created by the matchmaker")
+
+
+def rating(name):
+    return ratings.get(name, default_rating)
+
+
+def record_result(names, scores):
+    """Update the Elo ratings of a two player match, the higher score
+    wins."""
+    if len(names) != 2:
+        return
+    a, b = rating(names[0]), rating(names[1])
+    expected = 1 / (1 + 10 ** ((b - a) / 400.))
+    result = 0.5 if scores[0] == scores[1] else float(scores[0] > scores[1])
+    ratings[names[0]] = a + k_factor * (result - expected)
+    ratings[names[1]] = b - k_factor * (result - expected)
+
+
+class Matchmaker(object):
+    def __init__(self, start_match, window=50, widen_per_s=25,
+                 max_window=800, sweep_interval=1):
+        """`start_match` is called with each pair of players."""
+        self.start_match = start_match
+        self.base_window = window
+        self.widen_per_s = widen_per_s
+        self.max_window = max_window
+        self.sweep_interval = sweep_interval
+        self.keys = []  # sorted (rating, seq)
+        self.waiting = {}  # key -> (player, time queued)
+        self.keys_of = {}  # player -> set of its keys
+        self._seq = itertools.count()
+        self._sweep = task.LoopingCall(self.sweep)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, player):
+        key = (rating(player.name), next(self._seq))
+        i = bisect.bisect(self.keys, key)
+        self.keys.insert(i, key)
+        self.waiting[key] = (player, time.time())
+        self.keys_of.setdefault(player, set()).add(key)
+        if not self.pair_neighbour(i, time.time()) and not self._sweep.running:
+            self._sweep.start(self.sweep_interval, now=False)
+
+    def remove_player(self, player):
+        for key in list(self.keys_of.get(player, ())):
+            self._remove(key)
+
+    def _remove(self, key):
+        del self.keys[bisect.bisect_left(self.keys, key)]
+        player, queued_at = self.waiting.pop(key)
+        keys = self.keys_of[player]
+        keys.discard(key)
+        if not keys:
+            del self.keys_of[player]
+        if not self.keys and self._sweep.running:
+            self._sweep.stop()
+        return player, queued_at
+
+    def window(self, key, now):
+        waited = now - self.waiting[key][1]
+        return min(self.max_window,
+                   self.base_window + self.widen_per_s * waited)
+
+    def acceptable(self, a, b, now):
+        if self.waiting[a][0] is self.waiting[b][0]:
+            return False  # a multiplexed connection queued twice
+        return abs(a[0] - b[0]) <= min(self.window(a, now),
+                                       self.window(b, now))
+
+    def pair_neighbour(self, i, now):
+        key = self.keys[i]
+        candidates = [self.keys[j] for j in (i - 1, i + 1)
+                      if 0 <= j < len(self.keys)]
+        candidates = [other for other in candidates
+                      if self.acceptable(key, other, now)]
+        if not candidates:
+            return False
+        other = min(candidates, key=lambda other: abs(other[0] - key[0]))
+        self.pair(key, other, now)
+        return True
+
+    def pair(self, a, b, now):
+        players = []
+        for key in sorted((a, b), key=lambda key: self.waiting[key][1]):
+            player, queued_at = self._remove(key)
+            wait_seconds.observe(now - queued_at)
+            players.append(player)
+        matches_made.inc()
+        self.start_match(players)
+
+    def sweep(self):
+        now = time.time()
+        i = 0
+        while i < len(self.keys) - 1:
+            if self.acceptable(self.keys[i], self.keys[i + 1], now):
+                self.pair(self.keys[i], self.keys[i + 1], now)
+            else:
+                i += 1
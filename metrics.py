@@ -0,0 +1,149 @@
+#metrics.py
+# counters and histograms exposed in the prometheus text format over http.
+# recording a value is a dict lookup and a bisect, gauges are only
+# computed when scraped.
+
+import bisect
+
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+
+_metrics = []
+
+time_buckets = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05,
+                .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+size_buckets = (64, 256, 1024, 4096, 16384, 65536, 262144)
+
+
+def _label_str(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, value)
+                          for name, value in zip(names, values)) + "}"
+
+
+class Counter(object):
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        _metrics.append(self)
+
+    def inc(self, amount=1, *labels):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in sorted(self.values.items()):
+            yield self.name, _label_str(self.labels, labels), value
+
+
+class Gauge(object):
+    kind = "gauge"
+
+    def __init__(self, name, help, collect, labels=()):
+        """`collect` returns a dict of label value tuples -> value."""
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.collect = collect
+        _metrics.append(self)
+
+    def samples(self):
+        for labels, value in sorted(self.collect().items()):
+            yield self.name, _label_str(self.labels, labels), value
+
+
+class Histogram(object):
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=time_buckets, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self.values = {}  # labels -> [bucket counts, sum, count]
+        _metrics.append(self)
+
+    def observe(self, value, *labels):
+        try:
+            counts = self.values[labels]
+        except KeyError:
+            counts = self.values[labels] = [[0] * len(self.buckets), 0, 0]
+        i = bisect.bisect_left(self.buckets, value)
+        if i < len(self.buckets):
+            counts[0][i] += 1
+        counts[1] += value
+        counts[2] += 1
+
+    def samples(self):
+        for labels, (buckets, total, count) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets, buckets):
+                cumulative += n
+                yield (self.name + "_bucket",
+                       _label_str(self.labels + ("le",), labels + (bound,)),
+                       cumulative)
+            yield (self.name + "_bucket",
+                   _label_str(self.labels + ("le",), labels + ("+Inf",)),
+                   count)
+            label_str = _label_str(self.labels, labels)
+            yield self.name + "_sum", label_str, total
+            yield self.name + "_count", label_str, count
+
+
+def render():
+    lines = []
+    for metric in _metrics:
+        lines.append("# HELP {} {}".format(metric.name, metric.help))
+        lines.append("# TYPE {} {}".format(metric.name, metric.kind))
+        for name, labels, value in metric.samples():
+            lines.append("{}{} {}".format(name, labels, value))
+    return "\n".join(lines) + "\n"
+
+
+class MetricsResource(Resource):
+    isLeaf = True
+
+    def render_GET(self, request):
+        request.setHeader("Content-Type", "text/plain; version=0.0.4")
+        return render()
+
+
+def listen(reactor, port, interface=''):
+    return reactor.listenTCP(port, Site(MetricsResource()),
+                             interface=interface)
+
+
+turn_seconds = Histogram(
+    "rg_turn_resolution_seconds", "Time to resolve a turn (run_turn)")
+slowest_player_seconds = Histogram(
+    "rg_turn_wait_seconds",
+    "Time from the start of a turn until the last player's actions arrived")
+serialize_seconds = Histogram(
+    "rg_serialize_seconds", "Time to serialize a message",
+    labels=("type",))
+deserialize_seconds = Histogram(
+    "rg_deserialize_seconds", "Time to deserialize a message",
+    labels=("type",))
+bytes_out = Counter("rg_bytes_sent_total", "Message bytes sent")
+bytes_in = Counter("rg_bytes_received_total", "Message bytes received")
+messages_out = Counter("rg_messages_sent_total", "Messages sent")
+messages_in = Counter("rg_messages_received_total", "Messages received")
+connections_refused = Counter(
+    "rg_connections_refused_total", "Connections refused by admission control",
+    labels=("reason",))
+backpressure_pauses = Counter(
+    "rg_backpressure_pauses_total",
+    "Times reading from a client stopped until its output drained")
+spectator_frames_skipped = Counter(
+    "rg_spectator_frames_skipped_total",
+    "Turns not sent to spectators whose connection was backed up")
+compression_bytes = Counter(
+    "rg_compression_bytes_total",
+    "Bytes of compressed frames before (raw) and after compression",
+    labels=("stage",))
+compress_seconds = Histogram(
+    "rg_compress_seconds", "Time to compress a frame")
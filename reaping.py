@@ -0,0 +1,85 @@
+#reaping.py
+# expiry of idle matches and connections. watched items sit in a heap by
+# the earliest time they can expire; activity only stores a timestamp on
+# the item (`last_active`), so nothing is done per connection or message.
+# when an item's entry comes due it is checked once: expired items are
+# reaped, others are pushed back at their new expiry.
+
+import time
+import heapq
+import itertools
+
+from twisted.internet import task
+
+import metrics
+
+reaped_total = metrics.Counter(
+    "rg_reaped_total", "Idle matches and connections reaped",
+    labels=("reason",))
+reclaimed_total = metrics.Counter(
+    "rg_reaped_resources_total",
+    "Matches, players and spectators released by the reaper",
+    labels=("resource",))
+
+
+class Reaper(object):
+    def __init__(self, interval=1):
+        """Watched items have a `last_active` time, `idle_limit()` returning
+        (reason, seconds) or None once they are gone, and `reap(reason)`
+        returning {resource: count} of what was released. A reason of None
+        means the item can not be reaped now, it is looked at again after
+        the given seconds."""
+        self.interval = interval
+        self.heap = []  # (due, seq, item)
+        self.due = {}  # item -> due of its current heap entry
+        self.reaped = {}  # reason -> items reaped
+        self.reclaimed = {}  # resource -> count
+        self._seq = itertools.count()
+        self._check = task.LoopingCall(self.check)
+
+    def __len__(self):
+        return len(self.due)
+
+    def watch(self, item):
+        """(Re)schedule `item`, also after its limit changed."""
+        limit = item.idle_limit()
+        if limit is None:
+            self.due.pop(item, None)
+            return
+        reason, seconds = limit
+        due = (item.last_active if reason is not None else time.time()) + \
+            seconds
+        self.due[item] = due
+        heapq.heappush(self.heap, (due, next(self._seq), item))
+        if not self._check.running:
+            self._check.start(self.interval, now=False)
+
+    def check(self):
+        now = time.time()
+        while self.heap and self.heap[0][0] <= now:
+            due, _, item = heapq.heappop(self.heap)
+            if self.due.get(item) != due:
+                continue  # rescheduled or no longer watched
+            del self.due[item]
+            limit = item.idle_limit()
+            if limit is None:
+                continue
+            reason, seconds = limit
+            if reason is None or item.last_active + seconds > now:
+                self.watch(item)
+            else:
+                self.reap(item, reason)
+        if not self.heap and self._check.running:
+            self._check.stop()
+
+    def reap(self, item, reason):
+        released = item.reap(reason)
+        self.reaped[reason] = self.reaped.get(reason, 0) + 1
+        reaped_total.inc(1, reason)
+        for resource, count in released.items():
+            self.reclaimed[resource] = self.reclaimed.get(resource, 0) + count
+            reclaimed_total.inc(count, resource)
+
+    def stats(self):
+        return {'watched': len(self.due), 'reaped': dict(self.reaped),
+                'reclaimed': dict(self.reclaimed)}
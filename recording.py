@@ -0,0 +1,175 @@
+#recording.py
+# append-only match recordings. every turn appends the encoded State and the
+# actions each player sent for it, closing the file appends an index of turn
+# offsets. readers mmap the file and jump straight to any turn (files without
+# an index, e.g. of a crashed server, are scanned once instead).
+#
+#   header:  MAGIC, num_players (u8)
+#   turn:    turn (u32), state length (u32), state,
+#            num_players * (actions length (u32), actions)
+#   index:   num_turns * (turn (u32), offset (u64)),
+#            index offset (u64), num_turns (u32), INDEX_MAGIC
+
+import os
+import mmap
+import struct
+
+MAGIC = "RGREC\x01"
+INDEX_MAGIC = "RGIDX\x01"
+
+_header = struct.Struct("<B")
+_turn = struct.Struct("<II")
+_length = struct.Struct("<I")
+_entry = struct.Struct("<IQ")
+_footer = struct.Struct("<QI")
+
+
+class RecordingError(Exception):
+    pass
+
+
+class RecordingWriter(object):
+    def __init__(self, path, num_players, buffering=1 << 16):
+        self.path = path
+        self.num_players = num_players
+        self.file = open(path, "wb", buffering)
+        self.file.write(MAGIC + _header.pack(num_players))
+        self.offset = len(MAGIC) + _header.size
+        self.index = []  # (turn, offset)
+
+    def add_turn(self, turn, state_str, actions_strs):
+        """`actions_strs` holds the encoded actions of every player, an
+        empty string for players that sent none."""
+        parts = [_turn.pack(turn, len(state_str)), state_str]
+        for actions_str in actions_strs:
+            parts.append(_length.pack(len(actions_str)))
+            parts.append(actions_str)
+        data = "".join(parts)
+        self.file.write(data)
+        self.index.append((turn, self.offset))
+        self.offset += len(data)
+
+    def close(self):
+        if self.file is None:
+            return
+        index = "".join(_entry.pack(turn, offset)
+                        for turn, offset in self.index)
+        self.file.write(index + _footer.pack(self.offset, len(self.index)) +
+                        INDEX_MAGIC)
+        self.file.close()
+        self.file = None
+
+
+class Recording(object):
+    """Random access to the turns of a recording.
+
+        rec = Recording("a3.rgrec")
+        rec.state(5)  # encoded State after turn 5
+        rec.actions(5)  # the players' encoded actions that led to it
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            # mmap refuses empty files, the header is read unchecked
+            if os.fstat(f.fileno()).st_size < len(MAGIC) + _header.size:
+                raise RecordingError("{} is not a recording".format(path))
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(MAGIC)] != MAGIC:
+            raise RecordingError("{} is not a recording".format(path))
+        self.num_players, = _header.unpack_from(self.map, len(MAGIC))
+        self.offsets = self._read_index()
+        if self.offsets is None:
+            self.offsets = self._scan()
+
+    def _read_index(self):
+        end = len(self.map) - len(INDEX_MAGIC)
+        if end < 0 or self.map[end:] != INDEX_MAGIC:
+            return None
+        footer = end - _footer.size
+        if footer < len(MAGIC) + _header.size:
+            return None
+        index_offset, count = _footer.unpack_from(self.map, footer)
+        if index_offset + count * _entry.size != footer:
+            return None  # damaged index, scanned instead
+        offsets = {}
+        for i in range(count):
+            turn, offset = _entry.unpack_from(
+                self.map, index_offset + i * _entry.size)
+            offsets[turn] = offset
+        return offsets
+
+    def _scan(self):
+        # unclosed recording, a truncated last turn is ignored
+        offsets = {}
+        pos = len(MAGIC) + _header.size
+        size = len(self.map)
+        while pos + _turn.size <= size:
+            turn, length = _turn.unpack_from(self.map, pos)
+            end = pos + _turn.size + length
+            for _ in range(self.num_players):
+                if end + _length.size > size:
+                    return offsets
+                length, = _length.unpack_from(self.map, end)
+                end += _length.size + length
+            if end > size:
+                break
+            offsets[turn] = pos
+            pos = end
+        return offsets
+
+    def turns(self):
+        return sorted(self.offsets)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def _record(self, turn):
+        try:
+            pos = self.offsets[turn]
+        except KeyError:
+            raise RecordingError("Turn {} is not recorded".format(turn))
+        turn, length = _turn.unpack_from(self.map, pos)
+        pos += _turn.size
+        return pos, length
+
+    def state(self, turn):
+        pos, length = self._record(turn)
+        return self.map[pos:pos + length]
+
+    def actions(self, turn):
+        pos, length = self._record(turn)
+        pos += length
+        actions = []
+        for _ in range(self.num_players):
+            length, = _length.unpack_from(self.map, pos)
+            pos += _length.size
+            actions.append(self.map[pos:pos + length])
+            pos += length
+        return actions
+
+    def gamestate(self, turn, serializer=None):
+        if serializer is None:
+            from serialization import PB2Interface
+            serializer = PB2Interface()
+        return serializer.deserialize_gamestate(self.state(turn))
+
+    def close(self):
+        self.map.close()
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Inspect a match recording")
+    parser.add_argument('path', type=str)
+    parser.add_argument('turn', type=int, nargs='?',
+                        help="Print the robots of this turn")
+    args = parser.parse_args()
+
+    rec = Recording(args.path)
+    turns = rec.turns()
+    print "{} players, {} turns ({}-{})".format(
+        rec.num_players, len(turns), turns[0] if turns else None,
+        turns[-1] if turns else None)
+    if args.turn is not None:
+        for loc, bot in sorted(rec.gamestate(args.turn).robots.items()):
+            print loc, bot
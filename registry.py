@@ -0,0 +1,117 @@
+#registry.py
+# match registry. matches are indexed by status (open: waiting for players,
+# full: waiting for START, running), the ids of each status kept sorted so
+# LIST can page through them: a page starts after the cursor id (bisect)
+# and cursors stay valid while matches come and go between requests.
+
+import heapq
+import bisect
+import random
+import fractions
+
+statuses = ("open", "full", "running")
+
+
+class IdAllocator(object):
+    """Collision-free ids in O(1). A counter is mapped through a permutation
+    of all ids of the current length, so ids are as short as possible and
+    do not tell how many matches were created. Once every id of a length
+    was handed out the next length is used, ids are never reused."""
+    multiplier = 6364136223846793005
+
+    def __init__(self, charset, length=1):
+        if fractions.gcd(self.multiplier, len(charset)) != 1:
+            raise ValueError("Charset size shares a factor with the "
+                             "multiplier")
+        self.charset = charset
+        self.length = length
+        self.count = 0
+        self.salt = random.getrandbits(64)
+
+    def allocate(self):
+        base = len(self.charset)
+        space = base ** self.length
+        if self.count == space:
+            self.length += 1
+            self.count = 0
+            space *= base
+        n = (self.count * self.multiplier + self.salt) % space
+        self.count += 1
+        chars = []
+        for _ in range(self.length):
+            n, digit = divmod(n, base)
+            chars.append(self.charset[digit])
+        return "".join(chars)
+
+
+class MatchRegistry(object):
+    """Matches (or summaries of remote matches) by id, indexed by
+    status."""
+    def __init__(self):
+        self.items = {}  # id -> match
+        self.status = {}  # id -> status
+        self.index = dict((status, []) for status in statuses)  # sorted ids
+
+    def __contains__(self, match_id):
+        return match_id in self.items
+
+    def __getitem__(self, match_id):
+        return self.items[match_id]
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, match_id, default=None):
+        return self.items.get(match_id, default)
+
+    def values(self):
+        return self.items.values()
+
+    def add(self, match_id, item, status):
+        """Add or replace `match_id`."""
+        self.items[match_id] = item
+        self.set_status(match_id, status)
+
+    def set_status(self, match_id, status):
+        old = self.status.get(match_id)
+        if old == status:
+            return
+        if old is not None:
+            ids = self.index[old]
+            del ids[bisect.bisect_left(ids, match_id)]
+        bisect.insort(self.index[status], match_id)
+        self.status[match_id] = status
+
+    def remove(self, match_id):
+        """Remove `match_id` if registered, returns the match or None."""
+        status = self.status.pop(match_id, None)
+        if status is not None:
+            ids = self.index[status]
+            del ids[bisect.bisect_left(ids, match_id)]
+        return self.items.pop(match_id, None)
+
+    def counts(self):
+        return dict(((status,), len(ids))
+                    for status, ids in self.index.items())
+
+    def ids_after(self, status, cursor, limit):
+        """Up to `limit` ids of `status` (None for all) after `cursor`."""
+        lists = [self.index[status]] if status else self.index.values()
+        pages = []
+        for ids in lists:
+            i = bisect.bisect_right(ids, cursor) if cursor else 0
+            pages.append(ids[i:i + limit])
+        if len(pages) == 1:
+            return pages[0]
+        return list(heapq.merge(*pages))[:limit]
+
+
+def page(registries, status=None, cursor=None, limit=100):
+    """The next `limit` ids of `status` after `cursor` over several
+    registries, and the cursor of the page after it (None if this is the
+    last one)."""
+    ids = list(heapq.merge(*[registry.ids_after(status, cursor, limit + 1)
+                             for registry in registries]))[:limit + 1]
+    if len(ids) > limit:
+        return ids[:limit], ids[limit - 1]
+    return ids, None
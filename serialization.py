@@ -1,11 +1,12 @@
-import ast
-from rgkit.run import Options
-map_data = ast.literal_eval(open(Options().map_filepath).read())
+import sys
+import struct
 
 from rgkit.game import settings
 from rgkit.settings import Settings
 from rgkit.gamestate import GameState
 import match_pb2
+import maps
+import log
 
 action_type = {
     'ATTACK': match_pb2.ATTACK,
@@ -14,11 +15,72 @@ action_type = {
     'GUARD': match_pb2.GUARD
     }
 
-# add inverse mapping
+# add inverse mapping, to rgkit's action names
 action_type.update(
-    zip(action_type.values(), action_type.keys()))
+    zip(action_type.values(), [name.lower() for name in action_type.keys()]))
+targeted_actions = ('move', 'attack')
+
+def is_board(obj):
+    # board.py (and numpy) is only imported where Boards are used
+    board = sys.modules.get('board')
+    return board is not None and isinstance(obj, board.Board)
+
+class DeltaError(Exception):
+    pass
+
+class SettingsCache(object):
+    """Encoded Settings per map and game options, built once and without
+    the player_id. player_id is field 1, which protobuf serializes first,
+    so a player's Settings is its encoded player_id followed by the rest.
+    Only the encoding is cached: rgkit's Game reads its global settings,
+    which maps.apply() still points at a match's map."""
+    def __init__(self):
+        self.entries = {}  # key -> Settings bytes
+        self.player_ids = {}  # player_id -> encoded player_id field
+
+    def key(self, settings, map_name):
+        return (map_name, settings.player_count, settings.spawn_every,
+                settings.spawn_per_player, settings.max_turns)
+
+    def get(self, settings, map_name=None):
+        map_name = map_name or maps.default_map
+        key = self.key(settings, map_name)
+        try:
+            return self.entries[key]
+        except KeyError:
+            entry = self.entries[key] = self.encode(settings,
+                                                    maps.load(map_name))
+            return entry
+
+    def encode(self, settings, map_data):
+        sett = match_pb2.Settings()
+        sett.map.board_size = 19
+        
+        for x,y in map_data['obstacle']:
+            sett.map.obstacle_tiles.add(x=x, y=y)
+        for x,y in map_data['spawn']:
+            sett.map.spawn_tiles.add(x=x, y=y)
+
+        sett.spawn_period = settings.spawn_every
+        sett.num_players = settings.player_count
+        sett.spawn_amount = settings.spawn_per_player
+        sett.turns = settings.max_turns
+        
+        return sett.SerializePartialToString()
+
+    def player_id(self, pid):
+        try:
+            return self.player_ids[pid]
+        except KeyError:
+            field = match_pb2.Settings(player_id=pid).SerializePartialToString()
+            self.player_ids[pid] = field
+            return field
+
+settings_cache = SettingsCache()
 
 class SerializationInterface(object):
+    has_deltas = True  # False if serialize_delta gives full states
+
     def serialize_settings(self, *args, **kwargs):
         raise NotImplementedError
 
@@ -31,6 +93,12 @@ class SerializationInterface(object):
     def deserialize_gamestate(self, gamestate_str):
         raise NotImplementedError
 
+    def serialize_delta(self, gamestate, base=None):
+        raise NotImplementedError
+
+    def apply_delta(self, base, delta_str):
+        raise NotImplementedError
+
     def serialize_actions(self, actions, turn):
         raise NotImplementedError
     
@@ -38,7 +106,7 @@ class SerializationInterface(object):
         raise NotImplementedError
     
     def serialize(self, obj, *args, **kwargs):
-        if type(obj) == GameState:
+        if type(obj) == GameState or is_board(obj):
             return self.serialize_gamestate(obj, *args, **kwargs)
         elif type(obj) == Settings:
             return self.serialize_settings(obj, *args, **kwargs)
@@ -46,23 +114,9 @@ class SerializationInterface(object):
 
 # protobuf2 interface
 class PB2Interface(SerializationInterface):
-    def serialize_settings(self, settings, pid):
-        settings.init_map(map_data)
-        
-        sett = match_pb2.Settings(player_id=pid)
-        sett.map.board_size = 19
-        
-        for x,y in map_data['obstacle']:
-            sett.map.obstacle_tiles.add(x=x, y=y)
-        for x,y in map_data['spawn']:
-            sett.map.spawn_tiles.add(x=x, y=y)
-
-        sett.spawn_period = settings.spawn_every
-        sett.num_players = settings.player_count
-        sett.spawn_amount = settings.spawn_per_player
-        sett.turns = settings.max_turns
-        
-        return sett.SerializeToString()
+    def serialize_settings(self, settings, pid, map_name=None):
+        sett_str = settings_cache.get(settings, map_name)
+        return settings_cache.player_id(pid) + sett_str
 
     def deserialize_settings(self, sett_str):
         sett = match_pb2.Settings()
@@ -85,6 +139,8 @@ class PB2Interface(SerializationInterface):
     def serialize_gamestate(self, gamestate, player_id=None):
         # knowing player_id would be neede for hiding ids
         # but the point of hiding bot ids is beyond me anyway, so I'm not bothering
+        if is_board(gamestate):
+            return self.serialize_board(gamestate)
         state = match_pb2.State(turn=gamestate.turn)
         for loc, bot in gamestate.robots.items():
             location = match_pb2.Settings.Map.Coordinate(
@@ -93,8 +149,8 @@ class PB2Interface(SerializationInterface):
                 id=bot['robot_id'], location=location, hp=bot['hp'],
                 player_id=bot['player_id'])
         
-        #print state
-        print "turn:", state.turn
+        if log.turns.debug_on:
+            log.turns.debug("serialized turn %s", state.turn)
         return state.SerializeToString()
 
     def deserialize_gamestate(self, gamestate_str):
@@ -107,20 +163,104 @@ class PB2Interface(SerializationInterface):
             
         return gs
 
+    def serialize_board(self, board):
+        state = match_pb2.State(turn=board.turn)
+        for robot_id, x, y, player_id, hp in board.bots.tolist():
+            bot = state.bots.add(id=robot_id, hp=hp, player_id=player_id)
+            bot.location.x, bot.location.y = x, y
+        return state.SerializeToString()
+
+    def serialize_delta(self, gamestate, base=None):
+        # bots are matched by robot id, base=None gives a keyframe
+        if is_board(gamestate):
+            return self.serialize_board_delta(gamestate, base)
+        delta = match_pb2.StateDelta(turn=gamestate.turn)
+        if base is None:
+            delta.keyframe = True
+            old_bots = {}
+        else:
+            delta.base_turn = base.turn
+            old_bots = {bot['robot_id']: bot for bot in base.robots.values()}
+        
+        for loc, bot in gamestate.robots.items():
+            old_bot = old_bots.pop(bot['robot_id'], None)
+            if old_bot is None:
+                location = match_pb2.Settings.Map.Coordinate(x=loc[0], y=loc[1])
+                delta.spawned.add(
+                    id=bot['robot_id'], location=location, hp=bot['hp'],
+                    player_id=bot['player_id'])
+            elif (old_bot['location'] != bot['location'] or
+                  old_bot['hp'] != bot['hp']):
+                change = delta.changed.add(id=bot['robot_id'])
+                if old_bot['location'] != bot['location']:
+                    change.location.x, change.location.y = bot['location']
+                if old_bot['hp'] != bot['hp']:
+                    change.hp = bot['hp']
+        delta.removed.extend(old_bots)
+        
+        return delta.SerializeToString()
+
+    def serialize_board_delta(self, board, base=None):
+        delta = match_pb2.StateDelta(turn=board.turn)
+        if base is None:
+            delta.keyframe = True
+            spawned = board.bots
+        else:
+            delta.base_turn = base.turn
+            spawned, removed, changed, moved, hurt = board.diff(base)
+            delta.removed.extend(removed.tolist())
+            for (robot_id, x, y, player_id, hp), m, h in zip(
+                    changed.tolist(), moved.tolist(), hurt.tolist()):
+                change = delta.changed.add(id=robot_id)
+                if m:
+                    change.location.x, change.location.y = x, y
+                if h:
+                    change.hp = hp
+        for robot_id, x, y, player_id, hp in spawned.tolist():
+            bot = delta.spawned.add(id=robot_id, hp=hp, player_id=player_id)
+            bot.location.x, bot.location.y = x, y
+        
+        return delta.SerializeToString()
+
+    def apply_delta(self, base, delta_str):
+        delta = match_pb2.StateDelta()
+        delta.ParseFromString(delta_str)
+        gs = GameState(turn=delta.turn)
+        
+        if not delta.keyframe:
+            if base is None or base.turn != delta.base_turn:
+                raise DeltaError("Delta for turn {} does not apply to turn {}"
+                                 .format(delta.base_turn,
+                                         base.turn if base else None))
+            removed = set(delta.removed)
+            changed = {change.id: change for change in delta.changed}
+            for bot in base.robots.values():
+                if bot['robot_id'] in removed:
+                    continue
+                loc, hp = bot['location'], bot['hp']
+                change = changed.get(bot['robot_id'])
+                if change is not None:
+                    if change.HasField('location'):
+                        loc = (change.location.x, change.location.y)
+                    if change.HasField('hp'):
+                        hp = change.hp
+                gs.add_robot(loc, bot['player_id'], hp, bot['robot_id'])
+        
+        for bot in delta.spawned:
+            gs.add_robot((bot.location.x, bot.location.y),
+                         bot.player_id, bot.hp, bot.id)
+        
+        return gs
+
     def serialize_actions(self, actions, bots, turn):
         actions_pb = match_pb2.Actions(turn=turn)
         for loc, act in actions.items():
             action = actions_pb.actions.add(
                 bot_id=bots[loc]['robot_id'],
                 location=match_pb2.Settings.Map.Coordinate(x=loc[0], y=loc[1]),
-                type=action_type[act[0]])
-            try:
-                targ_loc = act[1]
-            except IndexError:
-                pass
-            else:
-                action.target = match_ob2.Settings.Map.Coordinate(
-                    x=targ_loc[0], y=targ_loc[1])
+                type=action_type[act[0].upper()])
+            if act[0].lower() in targeted_actions:
+                action.target.x, action.target.y = act[1]
                 
         return actions_pb.SerializeToString()
     
@@ -128,10 +268,77 @@ class PB2Interface(SerializationInterface):
         actions = match_pb2.Actions()
         actions.ParseFromString(actions_str)
         
-        actions = {(action.location.x, action.location.y):
-                       (action_type[action.type], (action.target.x, action.target.y)) for action in actions.actions}
+        turn = actions.turn
+        result = {}
+        for action in actions.actions:
+            name = action_type[action.type]
+            if name in targeted_actions:
+                result[action.location.x, action.location.y] = (
+                    name, (action.target.x, action.target.y))
+            else:
+                result[action.location.x, action.location.y] = (name,)
         
-        return actions
+        return turn, result
+
+# packed interface: the turn (u32), a bitmap of the occupied tiles of the
+# 19x19 board (bit x * 19 + y), then the hp (u8), player_id (u8) and robot
+# id (u32) arrays of the robots in tile order. a packed state is smaller
+# than most deltas, so "deltas" are full states. settings and actions are
+# protobuf as in PB2Interface.
+_packed_turn = struct.Struct("<I")
+_bitmap_size = (19 * 19 + 7) // 8
+_tiles = [(i // 19, i % 19) for i in range(19 * 19)]
+_bits = [tuple(bit for bit in range(8) if byte & (1 << bit))
+         for byte in range(256)]
+
+class PackedInterface(PB2Interface):
+    has_deltas = False
+
+    def serialize_gamestate(self, gamestate, player_id=None):
+        if is_board(gamestate):
+            bots = sorted((x * 19 + y, hp, player_id, robot_id)
+                          for robot_id, x, y, player_id, hp
+                          in gamestate.bots.tolist())
+        else:
+            bots = sorted((loc[0] * 19 + loc[1], bot['hp'], bot['player_id'],
+                           bot['robot_id'])
+                          for loc, bot in gamestate.robots.iteritems())
+        bitmap = bytearray(_bitmap_size)
+        for tile, _, _, _ in bots:
+            bitmap[tile >> 3] |= 1 << (tile & 7)
+        n = len(bots)
+        return "".join((
+            _packed_turn.pack(gamestate.turn), str(bitmap),
+            struct.pack("<{0}B{0}B{0}I".format(n),
+                        *([bot[1] for bot in bots] + [bot[2] for bot in bots] +
+                          [bot[3] for bot in bots]))))
+
+    def deserialize_gamestate(self, gamestate_str):
+        turn, = _packed_turn.unpack_from(gamestate_str)
+        offset = _packed_turn.size
+        locs = []
+        bitmap = memoryview(gamestate_str)[offset:offset + _bitmap_size]
+        for i, byte in enumerate(bytearray(bitmap)):
+            if byte:
+                for bit in _bits[byte]:
+                    locs.append(_tiles[i * 8 + bit])
+        offset += _bitmap_size
+        n = len(locs)
+        values = struct.unpack_from("<{0}B{0}B{0}I".format(n),
+                                    gamestate_str, offset)
+        gs = GameState(turn=turn)
+        for loc, hp, player_id, robot_id in zip(
+                locs, values[:n], values[n:2 * n], values[2 * n:]):
+            gs.add_robot(loc, player_id, hp, robot_id)
+        return gs
+
+    def serialize_delta(self, gamestate, base=None):
+        return self.serialize_gamestate(gamestate)
+
+    def apply_delta(self, base, delta_str):
+        return self.deserialize_gamestate(delta_str)
+
+codecs = {'pb2': PB2Interface(), 'packed': PackedInterface()}
 
 # json interface
 class JSONInterface(SerializationInterface):
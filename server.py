@@ -9,69 +9,183 @@
 #   server sends state to clients
 #   clients send actions to server
 
-import random
+import os
+import sys
+import time
+import socket
 import string
 import re
 import shlex
+import collections
 
 from twisted.protocols.basic import NetstringReceiver
 from twisted.internet.protocol import Protocol, Factory
-from twisted.protocols.policies import TimeoutMixin
 from twisted.internet.endpoints import TCP4ServerEndpoint
-from twisted.internet import reactor
+from twisted.internet import reactor, defer
+from twisted.internet.interfaces import IPushProducer
+from zope.interface import implementer
 
-from rgkit.game import Game, settings
+from rgkit.game import settings
 from rgkit.gamestate import GameState
 from serialization import PB2Interface as SerializationInterface
 import match_pb2
+import serialization
+import turns
+import games
+import cluster
+import log
+import maps
+import matchmaking
+import metrics
+import recording
+import registry
+import reaping
+import compression
+import framing
 
 
 host = "127.0.0.1"
 port = 8007
 
-timeout_in_s = 65536
+keyframe_interval = 10  # turns between full states for delta players
+mux_max_length = 1 << 20  # BATCH frames carry the actions of many matches
+record_dir = None  # directory to record matches to, None to not record
+max_skipped_turns = 50  # spectators falling further behind are dropped
+use_boards = False  # diff and encode states as numpy Boards
+compress_min_bytes = 128  # shorter frames are sent uncompressed
+
+# bytes of output buffered for a client before reading from it stops, until
+# the transport has written it all out
+write_high_watermark = 64 * 1024
+
+# seconds a match may wait for players (lobby), for START once it is full
+# (start) and for actions during a turn (turn), and a connection may sit
+# in the lobby without sending a command (lobby), 0 for no limit
+idle_limits = {'lobby': 300, 'start': 120, 'turn': 60}
+idle_reasons = {'open': 'lobby', 'full': 'start', 'running': 'turn'}
+
+list_page_size = 100  # matches per LIST reply, unless limit= is given
+max_list_limit = 1000
    
-matches = {}  # game_id -> game
+matches = registry.MatchRegistry()  # game_id -> game
 
 id_charset = string.ascii_letters + string.digits
 
 join_re = re.compile(r"(?<=^JOIN )[{}]+$".format(id_charset))
 players_re = re.compile(r"(?<=^PLAYERS )[{}]+$".format(id_charset))
-name_re = re.compile(r"(?<=^NAME )[a-zA-Z0-9-_.]+$")
+watch_re = re.compile(r"(?<=^WATCH )[{}]+$".format(id_charset))
+name_re = re.compile(r"^NAME ([a-zA-Z0-9-_.]+)(?: compress=(\w+))?$")
 create_re = re.compile(r"(?<=^CREATE ).+$")
+queue_re = re.compile(r"^QUEUE(?: ([12]))?$")
+list_re = re.compile(r"^LIST(?: ({}))?(?: limit=(\d+))?(?: cursor=([{}]+))?$"
+                     .format("|".join(registry.statuses), id_charset))
 
 
 class MatchError(Exception):
     pass
 
 
+def match_owner(match_id):
+    # clustered match ids are prefixed by the owning worker's index
+    if cluster.worker_index is None:
+        return None
+    return id_charset.index(match_id[0])
+
+
+def split_netstrings(data, max_prefix_length=10):
+    frames = []
+    pos = 0
+    while pos < len(data):
+        colon = data.index(':', pos)
+        prefix = data[pos:colon]
+        # int() would also take signs and spaces, a negative length would
+        # move pos backwards
+        if not prefix.isdigit() or len(prefix) > max_prefix_length:
+            raise ValueError("Invalid netstring length prefix")
+        end = colon + 1 + int(prefix)
+        if end >= len(data) or data[end] != ',':
+            raise ValueError("Missing netstring terminator")
+        frames.append(data[colon + 1:end])
+        pos = end + 1
+    return frames
+
+
+def max_message_length(board_size=None):
+    # "TURN " and an Actions message with an action for every tile
+    board_size = board_size or settings.board_size
+    return 64 + 32 * board_size ** 2
+
+
+def start_matched(players):
+    # players paired by the matchmaker (or a single player)
+    match = NetworkGame(len(players))
+    match.rated = True
+    for player in players:
+        match.add_player(player.seat(match.id))
+    for seat in match.players:
+        match.start(seat)
+
+
+matchmaker = matchmaking.Matchmaker(start_matched)
+matchmaking_worker = 0  # clustered, QUEUE is handed off to this worker
+reaper = reaping.Reaper()
+
+
+def match_summaries():
+    return [match.summary() for match in matches.values()]
+
+
 class NetworkGame(object):
-    id_length = 1
-    def __init__(self, num_players):
+    ids = registry.IdAllocator(id_charset)
+    def __init__(self, num_players, turn_ms=None, map_name=None):
         self.id, self.uri = NetworkGame.id_gen()
         self.serializer = SerializationInterface()
         
         self.game = None
         self.players = []
+        self.spectators = set()
         self.max_players = num_players
-        matches[self.id] = self
+        self.map_name = map_name or maps.default_map
+        self.rated = False  # created by the matchmaker
         
         self.turn = 0
         self.actions = [None] * num_players
+        self.robot_index = [{} for _ in range(num_players)]
+        self.ended = False
+        self._turn_lock = defer.DeferredLock()
+        
+        # per-turn deadline, players missing it get their robots guarded
+        self.turn_ms = turn_ms
+        self._deadline = None  # IDelayedCall
+        self._deadline_at = None
+        self.missed_deadlines = [0] * num_players
+        self.late_ms = [0.0] * num_players  # total lateness of late actions
+        self._missed_at = [None] * num_players
+        self._turn_started = None
+        self.last_active = time.time()  # status change or turn start
+        matches.add(self.id, self, self.status)
+        reaper.watch(self)
+        self.publish()
+        
+        # encoded gamestates of the current turn, shared by all players
+        self._encoded = {}  # (codec, "state" | "delta" | "keyframe") -> str
+        self._base_state = None  # previous turn's state, for deltas
+        self._board = None  # Boards of both states, if use_boards
+        self._base_board = None
+        self.encodes_avoided = 0
+        
+        self.recorder = None  # recording.RecordingWriter
+        self._actions_strs = [""] * num_players  # as sent, for the recording
     
     def player_id(self, player):
         return self.players.index(player)
     
     @classmethod
     def id_gen(cls):
-        while True:
-            i = ''.join(random.choice(id_charset)
-                        for _ in range(cls.id_length))
-            if i in matches:
-                cls.id_length += 1
-            else:
-                break
-        
+        prefix = ''
+        if cluster.worker_index is not None:
+            prefix = id_charset[cluster.worker_index]
+        i = prefix + cls.ids.allocate()
         return i, 'rg-match://{host}:{port}/{id}'.format(
             host=host, port=port, id=i)
 
@@ -82,132 +196,479 @@ class NetworkGame(object):
             player.match = self
             player.state = "JOINED"
             player.write(self.uri)
+            self.publish()
         else:
             raise MatchError("Match is full")
     
+    def add_spectator(self, player):
+        spectator = Spectator(player, self)
+        self.spectators.add(spectator)
+        player.spectator = spectator
+        player.state = "WATCHING"
+        player.write(self.uri)
+        if self.game is not None:
+            spectator.send("STARTED", self.spectator_settings())
+            spectator.send("TURN", self.encoded_gamestate(
+                "state", player.codec))
+        self.publish()
+    
+    def remove_spectator(self, spectator):
+        self.spectators.discard(spectator)
+        spectator.player.spectator = None
+        if not self.ended:
+            self.publish()
+    
+    def spectator_settings(self):
+        # spectators are not a player, player_id = -1
+        return self.serializer.serialize(settings, -1, map_name=self.map_name)
+    
+    def broadcast(self, state, data):
+        # framed once, skipped by spectators whose connection is backed up
+        frames = {}  # binary -> frame
+        for spectator in list(self.spectators):
+            player = spectator.player
+            try:
+                frame = frames[player.binary]
+            except KeyError:
+                frame = frames[player.binary] = player.frame(state, data)
+            spectator.send_frame(frame)
+    
+    def broadcast_gamestate(self, state):
+        frames = {}  # (codec, binary) -> frame
+        for spectator in list(self.spectators):
+            player = spectator.player
+            key = player.codec, player.binary
+            try:
+                frame = frames[key]
+            except KeyError:
+                frame = frames[key] = player.frame(
+                    state, self.encoded_gamestate("state", player.codec))
+            spectator.send_frame(frame)
+    
+    @property
+    def status(self):
+        if self.game is not None:
+            return "running"
+        if len(self.players) == self.max_players:
+            return "full"
+        return "open"
+    
+    def summary(self):
+        return {'id': self.id, 'uri': self.uri, 'status': self.status,
+                'spectators': len(self.spectators),
+                'max_players': self.max_players,
+                'players': ["{} {}{}".format(
+                    player.name, id(player), self.lateness_str(player_id))
+                    for player_id, player in enumerate(self.players)]}
+    
+    def lateness_str(self, player_id):
+        if not self.missed_deadlines[player_id]:
+            return ""
+        return " (missed {} deadlines, {:.0f} ms late)".format(
+            self.missed_deadlines[player_id], self.late_ms[player_id])
+    
+    def publish(self):
+        if self.ended:
+            cluster.retract(self.id)
+        else:
+            if matches.status[self.id] != self.status:
+                # open -> full -> running, each with its own idle limit
+                matches.set_status(self.id, self.status)
+                self.last_active = time.time()
+                reaper.watch(self)
+            cluster.publish(self.summary())
+    
+    def index_robots(self):
+        # player_id -> {location: robot_id}, rebuilt once per turn
+        self.robot_index = [{} for _ in range(self.max_players)]
+        for loc, robot in self.game._state.robots.iteritems():
+            self.robot_index[robot['player_id']][loc] = robot['robot_id']
+    
+    def sanitize(self, player, actions):
+        player_robots = self.robot_index[player._player_id]
+        a = {}
+        # robots for which actions were not given
+        for loc in player_robots:
+            try:
+                a[loc] = actions[loc]
+            except KeyError:
+                a[loc] = ('guard',)
+                if log.turns.debug_on:
+                    log.turns.debug("missing action for %s player=%s",
+                                    loc, id(player))
+        if log.turns.debug_on and len(a) < len(actions):
+            log.turns.debug("ignored actions for robots not owned by "
+                            "player=%s: %r", id(player),
+                            [loc for loc in actions if loc not in a])
+        return a
+    
     def add_actions(self, player, actions_str):
-        player_robots = {l:r for l,r in self.game._state.robots.items()
-                         if r['player_id'] == player._player_id}
-        def sanitize(actions):
-            a = {}
-            # robots for which actions were not given
-            for loc in player_robots:
-                try:
-                    a[loc] = actions[loc]
-                except KeyError:
-                    a[loc] = ('guard')
-                    print "missing action for", loc, "player=", id(player)
-            return a
-        
         player_id = self.player_id(player)
-        actions = self.serializer.deserialize_actions(actions_str)
-        print "actions=", repr(actions)
-        actions = sanitize(actions)
-        print "player_robots=", repr(player_robots)
-        print "sanitizedactions=", repr(actions)
+        t = time.time()
+        turn, actions = self.serializer.deserialize_actions(actions_str)
+        metrics.deserialize_seconds.observe(time.time() - t, "actions")
+        
+        if turn != self.game._state.turn or self._turn_lock.locked:
+            # turn was resolved without this player
+            if self._missed_at[player_id] is not None:
+                self.late_ms[player_id] += 1000 * (
+                    time.time() - self._missed_at[player_id])
+                self._missed_at[player_id] = None
+            log.turns.info("late actions for turn %s player=%s",
+                           turn, id(player))
+            return
+        
+        if log.turns.debug_on:
+            log.turns.debug("actions=%r", actions)
+        actions = self.sanitize(player, actions)
         self.actions[player_id] = actions
+        self._actions_strs[player_id] = actions_str
         # once all actions are processed
         
         if all(p_actions is not None for p_actions in self.actions):
-            print "runturn"
-            self.game.run_turn()
+            metrics.slowest_player_seconds.observe(
+                time.time() - self._turn_started)
+            self.resolve_turn()
+    
+    def resolve_turn(self):
+        if self._deadline is not None and self._deadline.active():
+            self._deadline.cancel()
+        self._deadline = None
+        
+        if log.turns.debug_on:
+            log.turns.debug("Game %s running turn %s",
+                            self.id, self.game._state.turn)
+        d = self.run_turn()
+        d.addCallback(lambda _: self.end_turn())
+        d.addErrback(self.turn_failed)
+    
+    def start_turn(self):
+        self._turn_started = self.last_active = time.time()
+        if self.turn_ms is not None:
+            self._deadline_at = time.time() + self.turn_ms / 1000.
+            self._deadline = reactor.callLater(
+                self.turn_ms / 1000., self.deadline_expired)
+    
+    def player_ready(self):
+        # the first turn (and its deadline) starts once every player sent
+        # TURN, players still JOINED or STARTED can not be sent gamestates
+        if self._turn_started is None and all(
+                player.state == "TURN" for player in self.players):
+            self.start_turn()
+    
+    def deadline_expired(self):
+        self._deadline = None
+        for player_id, player in enumerate(self.players):
+            if self.actions[player_id] is None:
+                self.missed_deadlines[player_id] += 1
+                self._missed_at[player_id] = self._deadline_at
+                self.actions[player_id] = self.sanitize(player, {})
+                log.turns.info("Game %s player %s missed turn %s deadline",
+                               self.id, id(player), self.game._state.turn)
+        metrics.slowest_player_seconds.observe(
+            time.time() - self._turn_started)
+        self.resolve_turn()
+    
+    def end_turn(self):
+        if self.ended:  # aborted while the turn was resolved
+            return
+        
+        self.record()
+        ended = games.game_over(self.game)
+        if ended:
+            for player in self.players:
+                player.state = "ENDED"
+                
+        for player_id, player in enumerate(self.players):
+            self.actions[player_id] = None
+            self.send_gamestate(player)
+        
+        if self.spectators:
+            self.broadcast_gamestate("ENDED" if ended else "TURN")
             
-            if self.game._state.turn > settings.max_turns:
-                for player in self.players:
-                    player.state = "ENDED"
-                    
+        if ended:
+            self.ended = True
+            matches.remove(self.id)
+            self.publish()
+            self.stop_recording()
+            if self.rated:
+                matchmaking.record_result(
+                    [player.name for player in self.players],
+                    [len(robots) for robots in self.robot_index])
+            for spectator in list(self.spectators):
+                spectator.drop()
             for player_id, player in enumerate(self.players):
-                self.actions[player_id] = None
-                self.send_gamestate(player)
-                
-            if self.game._state.turn > settings.max_turns:
-                del matches[self.id]
-                for player in self.players:
-                    player.match = None
-                    player.transport.loseConnection()
-                print "Game {} ended".format(self.id)
+                player.match = None
+                player.drop()
+                if self.missed_deadlines[player_id]:
+                    log.lifecycle.info("Game %s player %s%s", self.id,
+                                       id(player), self.lateness_str(player_id))
+            log.lifecycle.info("Game %s ended (%s state encodes avoided)",
+                               self.id, self.encodes_avoided)
+        else:
+            self.start_turn()
+    
+    def turn_failed(self, failure):
+        log.lifecycle.error("Game %s turn %s failed: %s", self.id,
+                            self.game._state.turn, failure.getErrorMessage())
+        if not self.ended:
+            self.abort()
+    
+    def run_turn(self):
+        # turns of a match are resolved one at a time, in order
+        return self._turn_lock.run(self._resolve_turn)
+    
+    def _resolve_turn(self):
+        base_state = self.game._state
+        d = turns.resolve(self.game, self.actions, self.map_name)
+        d.addCallback(self._turn_resolved, base_state, time.time())
+        return d
+    
+    def _turn_resolved(self, state, base_state, t):
+        metrics.turn_seconds.observe(time.time() - t)
+        self.game._state = state
+        self._base_state = base_state
+        self._encoded = {}
+        self.index_robots()
+        if use_boards:
+            import board  # numpy, only with --boards
+            self._base_board = self._board
+            self._board = board.Board.from_gamestate(state)
+    
+    def record(self):
+        # the state after this turn and the actions that led to it
+        if self.recorder is not None:
+            self.recorder.add_turn(self.game._state.turn,
+                                   self.encoded_gamestate("state"),
+                                   self._actions_strs)
+        self._actions_strs = [""] * self.max_players
+    
+    def stop_recording(self):
+        if self.recorder is not None:
+            self.recorder.close()
+            log.lifecycle.info("Game %s recorded to %s",
+                               self.id, self.recorder.path)
+            self.recorder = None
+    
+    def encoded_gamestate(self, kind="state", codec="pb2"):
+        serializer = serialization.codecs[codec]
+        if not serializer.has_deltas:
+            kind = "state"
+        try:
+            encoded = self._encoded[codec, kind]
+        except KeyError:
+            t = time.time()
+            if self._board is not None:
+                state, base_state = self._board, self._base_board
+            else:
+                state, base_state = self.game._state, self._base_state
+            if kind == "state":
+                encoded = serializer.serialize(state)
+            elif kind == "delta":
+                encoded = serializer.serialize_delta(state, base_state)
+            else:
+                encoded = serializer.serialize_delta(state)
+            metrics.serialize_seconds.observe(
+                time.time() - t, kind if codec == "pb2" else codec + "_" + kind)
+            self._encoded[codec, kind] = encoded
+        else:
+            self.encodes_avoided += 1
+        return encoded
         
-    def send_gamestate(self, player):
-        gamestate_str = self.serializer.serialize(self.game._state)
-        player.write(gamestate_str)
+    def send_gamestate(self, player, keyframe=False):
+        if not player.deltas:
+            kind = "state"
+        elif (keyframe or self._base_state is None or
+              self.game._state.turn % keyframe_interval == 0):
+            kind = "keyframe"
+        else:
+            kind = "delta"
+        player.write(self.encoded_gamestate(kind, player.codec))
     
     def start(self, player):       
         if len(self.players) == self.max_players:
             player.state = "STARTED"
-            sett_str = self.serializer.serialize(settings, self.player_id(player))
+            t = time.time()
+            sett_str = self.serializer.serialize(
+                settings, self.player_id(player), map_name=self.map_name)
+            metrics.serialize_seconds.observe(time.time() - t, "settings")
             player.write(sett_str)
             
             if self.game is None:
                 #print settings
-                self.game = Game(self.players, record_actions=False,
-                                record_history=False, symmetric=True)
+                self.game = games.new_game(self.players, self.map_name)
                 self.actions = [{}] * self.max_players
-                self.game.run_turn() #spawn bots
+                self.game.run_turn() #spawn bots, cheap enough to do inline
                 self.actions = [None] * self.max_players
+                self.index_robots()
+                self.publish()
+                if use_boards:
+                    import board
+                    self._board = board.Board.from_gamestate(self.game._state)
+                if record_dir is not None:
+                    self.recorder = recording.RecordingWriter(
+                        os.path.join(record_dir, "{}-{}.rgrec".format(
+                            time.strftime("%Y%m%d-%H%M%S"), self.id)),
+                        self.max_players)
+                    self.record()
+                if self.spectators:
+                    self.broadcast("STARTED", self.spectator_settings())
+                    self.broadcast_gamestate("TURN")
             
         else:
             raise MatchError("Match is not full")
     
-    def abort(self):
-        del matches[self.id]
+    def idle_limit(self):
+        if self.ended:
+            return None
+        reason = idle_reasons[self.status]
+        if not idle_limits[reason]:
+            return None  # watched again on the next status change
+        return reason, idle_limits[reason]
+    
+    def reap(self, reason):
+        log.lifecycle.info("Game %s idle (%s), aborting", self.id, reason)
+        released = {'matches': 1, 'players': len(self.players),
+                    'spectators': len(self.spectators)}
+        self.abort("Match aborted, idle for too long.")
+        return released
+    
+    def abort(self, reason="Player disconnected from match."):
+        self.ended = True
+        if self._deadline is not None and self._deadline.active():
+            self._deadline.cancel()
+        matches.remove(self.id)
+        self.publish()
+        self.stop_recording()
         for player in self.players:
             player.match = None
             player.state = "DISCONNECTED"
-            player.write("Player disconnected from match.")
-            player.transport.loseConnection()
-        print "Game {} aborted".format(self.id)
+            player.write(reason)
+            player.drop()
+        for spectator in list(self.spectators):
+            spectator.send("DISCONNECTED", reason)
+            spectator.drop()
+        log.lifecycle.info("Game %s aborted", self.id)
+
+@implementer(IPushProducer)
+class Backpressure(object):
+    """The streaming producer of a player's transport. The transport pauses
+    it past the high watermark of buffered output, reading from the client
+    stops (and spectators skip turns) until the transport resumes it once
+    the output was written out."""
+    def __init__(self, transport):
+        self.transport = transport
+        self.paused = False
+        transport.bufferSize = write_high_watermark
+        transport.registerProducer(self, True)
+    
+    def pauseProducing(self):
+        if self.paused:
+            return
+        self.paused = True
+        metrics.backpressure_pauses.inc()
+        self.transport.pauseProducing()
+    
+    def resumeProducing(self):
+        if not self.paused:
+            return
+        self.paused = False
+        self.transport.resumeProducing()
+    
+    def stopProducing(self):
+        pass
 
-class Player(NetstringReceiver, TimeoutMixin):
+
+class Spectator(object):
+    """A read-only connection to a match. While its connection is backed up
+    turns are skipped instead of queued."""
+    def __init__(self, player, match):
+        self.player = player
+        self.match = match
+        self.skipped = 0
+    
+    def send(self, state, data):
+        self.send_frame(self.player.frame(state, data))
+    
+    def send_frame(self, frame):
+        if not self.player.backpressure.paused:
+            self.skipped = 0
+            self.player.send_frame(frame)
+            return
+        self.skipped += 1
+        metrics.spectator_frames_skipped.inc()
+        if self.skipped > max_skipped_turns:
+            log.lifecycle.info("Game %s dropping spectator %s (%s turns "
+                               "behind)", self.match.id, id(self.player),
+                               self.skipped)
+            self.drop()
+    
+    def detach(self):
+        if self in self.match.spectators:
+            self.match.remove_spectator(self)
+    
+    def drop(self):
+        self.detach()
+        self.player.drop()
+
+
+class MatchSession(object):
     """
-    states = CONNECTED | JOINED | STARTED | TURN | DISCONNECTED
+    A player's seat in one match, driven by the commands of a connection.
+    states = CONNECTED | SEARCHING | JOINED | STARTED | TURN | DISCONNECTED |
+             WATCHING | HANDOFF
     """
-    def __init__(self, factory):
+    def __init__(self):
         self.match = None
         self._player_id = None
+        self.deltas = False
+        self.codec = "pb2"  # gamestate encoding, see serialization.codecs
+        self.compress = False  # frames compressed, see compression.py
         
         self.state = "CONNECTED"
         self.name = "Unnamed Player"
-        self.factory = factory
-        self.MAX_LENGTH = 128  # seconds
-        self.setTimeout(timeout_in_s)
-
-    def connectionMade(self):
-        self.factory.numProtocols = self.factory.numProtocols + 1
-        peer = self.transport.getPeer()
-        self.peer = "{}:{}".format(peer.host, peer.port)
-        self.write(
-            "Welcome! There are currently %d open connections." %
-            (self.factory.numProtocols,))
-        if self.factory.numProtocols > 8:
-            self.state = "DISCONNECTED"
-            self.write("Sorry, too many players connected!")
-            self.transport.loseConnection()
-
-    def connectionLost(self, reason):
-        print "dc", id(self)
-        self.factory.numProtocols = self.factory.numProtocols - 1
-        if self.match:  # should only exist if JOINED or STARTED
-            self.match.abort()
 
     def write(self, data):
-        s = "{} {}".format(self.state, data)
-        print ">> {} {}: {}".format(self.peer, id(self), repr(s))
-        self.sendString(s)
+        raise NotImplementedError
 
-    def stringReceived(self, data):
-        print "<< {} {}: {}".format(self.peer, id(self), repr(data))
+    def drop(self):
+        raise NotImplementedError
+
+    def handle(self, data):
         if self.state == "CONNECTED":
             
-            # NAME <name>
+            # NAME <name> [compress=<method>]
             if re.search(name_re, data):
-                self.name = re.search(name_re, data).group(0)
-                self.write("Hello, {}".format(self.name))
+                name, method = re.search(name_re, data).groups()
+                if method is not None and method not in compression.methods:
+                    self.write("Unknown compression {}".format(method))
+                    return
+                self.name = name
+                self.compress = method is not None
+                if self.compress:
+                    self.write("Hello, {} (compress={})".format(name, method))
+                else:
+                    self.write("Hello, {}".format(self.name))
+            
+            # CODEC <codec>
+            elif data.startswith("CODEC "):
+                codec = data[len("CODEC "):]
+                if codec in serialization.codecs:
+                    self.codec = codec
+                    self.write("Codec {}".format(codec))
+                else:
+                    self.write("Unknown codec {}".format(codec))
             
             # JOIN <match_id>
             elif re.search(join_re, data):
                 match_id = re.search(join_re, data).group(0)
                 self.join_match(match_id)
             
+            # WATCH <match_id>
+            elif re.search(watch_re, data):
+                match_id = re.search(watch_re, data).group(0)
+                self.watch_match(match_id)
+            
             # CREATE <match_options>
             elif re.search(create_re, data):
                 options = {}
@@ -220,18 +681,31 @@ class Player(NetstringReceiver, TimeoutMixin):
                         return
                 self.create_match(options)
             
-            # LIST
-            elif data == "LIST":
-                self.print_matches()
+            # LIST [open|full|running] [limit=<n>] [cursor=<match_id>]
+            elif re.search(list_re, data):
+                self.print_matches(*re.search(list_re, data).groups())
             
             # PLAYERS <match_id>
             elif re.search(players_re, data):
                 match_id = re.search(players_re, data).group(0)
                 self.print_players(match_id)
+            
+            # QUEUE [num_players]
+            elif re.search(queue_re, data):
+                num_players = int(re.search(queue_re, data).group(1) or 2)
+                self.queue_for_match(num_players)
                     
             else:
                 self.write("Invalid command")
 
+        elif self.state == "SEARCHING":
+            if data == "LEAVE":
+                matchmaker.remove_player(self)
+                self.state = "CONNECTED"
+                self.write("Left the queue")
+            else:
+                self.write("Searching for a match")
+
         elif self.state == "JOINED": 
             if data == "START":
                 try:
@@ -239,37 +713,68 @@ class Player(NetstringReceiver, TimeoutMixin):
                 except MatchError:
                     self.print_players(self.match.id)
         elif self.state == "STARTED":
-            if data == "TURN":
+            # TURN [DELTA]
+            if data in ("TURN", "TURN DELTA"):
                 self.state = "TURN"
-                self.match.send_gamestate(self)
+                self.deltas = data == "TURN DELTA"
+                self.match.send_gamestate(self, keyframe=True)
+                self.match.player_ready()
             else:
-                self.loseConnection()
+                self.drop()
         elif self.state == "TURN":
             s = "TURN "
             if data.startswith(s):
                 actions_str = data[len(s):]
                 self.match.add_actions(self, actions_str)
+            elif data == "KEYFRAME":
+                self.match.send_gamestate(self, keyframe=True)
             else:
-                self.loseConnection()
+                self.drop()
+        elif self.state == "WATCHING":
+            pass  # spectators are read-only
         else:
             raise Exception("Unknown state")
     
-    def print_matches(self):
-        if matches:
-            self.write(", ".join("{} ({}/{}): ".format(
-                match.id, len(match.players), match.max_players)
-                for match in matches.values()))
-        else:
-            self.write("No matches created.")
+    def print_matches(self, status=None, limit=None, cursor=None):
+        limit = min(int(limit), max_list_limit) if limit else list_page_size
+        if not limit:
+            self.write("Invalid limit")
+            return
+        ids, next_cursor = registry.page([matches, cluster.remote_matches],
+                                         status, cursor, limit)
+        if not ids:
+            self.write("No matches created." if status is None and
+                       cursor is None else "No more matches.")
+            return
+        entries = []
+        for match_id in ids:
+            match = matches.get(match_id)
+            if match is not None:
+                players, max_players = len(match.players), match.max_players
+            else:
+                match = cluster.remote_matches[match_id]
+                players, max_players = (len(match['players']),
+                                        match['max_players'])
+            entries.append("{} ({}/{}): ".format(match_id, players,
+                                                 max_players))
+        more = ""
+        if next_cursor is not None:
+            more = " (more: cursor={})".format(next_cursor)
+        self.write(", ".join(entries) + more)
     
     def print_players(self, match_id):
         try:
-            match = matches[match_id]
+            if match_id in matches:
+                match = matches[match_id].summary()
+            else:
+                match = cluster.remote_matches[match_id]
             list_str = "{} ({}/{}) ".format(
-                match.uri, len(match.players), match.max_players)
+                match['uri'], len(match['players']), match['max_players'])
+            watching = ""
+            if match['spectators']:
+                watching = " ({} watching)".format(match['spectators'])
             
-            self.write(list_str + ", ".join("{} {}".format(
-                player.name, id(player)) for player in match.players))
+            self.write(list_str + ", ".join(match['players']) + watching)
         except KeyError:
             self.write("Match does not exist!")
     
@@ -280,12 +785,44 @@ class Player(NetstringReceiver, TimeoutMixin):
                 raise ValueError
         except KeyError:
             self.write("Missing num_players option")
+            return
         except ValueError:
             self.write("Invalid num_players value")
-        else:
-            match = NetworkGame(num_players)
-            self.join_match(match.id)
+            return
+        
+        try:
+            turn_ms = options.get('turn_ms')
+            if turn_ms is not None:
+                turn_ms = int(turn_ms)
+                if turn_ms <= 0:
+                    raise ValueError
+        except ValueError:
+            self.write("Invalid turn_ms value")
+            return
+        
+        map_name = options.get('map')
+        if map_name is not None:
+            try:
+                maps.load(map_name)
+            except (maps.MapError, SyntaxError, ValueError):
+                self.write("Invalid map {}".format(map_name))
+                return
+        
+        match = NetworkGame(num_players, turn_ms=turn_ms, map_name=map_name)
+        self.join_match(match.id)
 
+    def queue_for_match(self, num_players):
+        if num_players == 1:
+            start_matched([self])
+            return
+        self.state = "SEARCHING"
+        self.write("Searching for a match (rating {:.0f})".format(
+            matchmaking.rating(self.name)))
+        matchmaker.add(self)
+    
+    def seat(self, match_id):
+        return self
+    
     def join_match(self, match_id):
         try:
             matches[match_id].add_player(self)
@@ -293,19 +830,381 @@ class Player(NetstringReceiver, TimeoutMixin):
             self.write("Match does not exist!")
         except MatchError:
             self.write("Match is full!")
+    
+    def watch_match(self, match_id):
+        try:
+            matches[match_id].add_spectator(self)
+        except KeyError:
+            self.write("Match does not exist!")
             
     def get_responses(self, state, seed):
         return self.match.actions[self._player_id], {}
     
     def set_player_id(self, pid):
         self._player_id = pid
+
+
+class MuxSession(MatchSession):
+    """A match played over a multiplexed connection, framed as
+    "@<match_id> <state> <data>"."""
+    def __init__(self, connection, match_id):
+        MatchSession.__init__(self)
+        self.connection = connection
+        self.match_id = match_id
+        self.name = connection.name
+        self.codec = connection.codec
+
+    def write(self, data):
+        self.connection.send_frame(self.connection.frame(
+            self.state, data, self.match_id))
+
+    def drop(self):
+        # only the session ends, its match is aborted like on a disconnect
+        self.connection.sessions.pop(self.match_id, None)
+        if self.match is not None:
+            self.match.abort()
+
+
+class Player(MatchSession, NetstringReceiver):
+    def __init__(self, factory):
+        MatchSession.__init__(self)
+        self.adopted = None  # (player info, command, data) if handed to us
+        self.received = ""  # data not yet consumed as netstrings
+        self.consumed = 0
+        self.sessions = None  # match_id -> MuxSession after MUX
+        self.spectator = None  # Spectator while WATCHING
+        self.admission = None  # "active" | "queued" | "refused"
+        self.backpressure = None
+        self.compressed = [0, 0, 0.0]  # bytes before, after, seconds
+        self.binary = False  # binary frames, see framing.py
+        
+        self.factory = factory
+        self.MAX_LENGTH = max_message_length()
+        self.last_active = time.time()  # last command received
+
+    def connectionMade(self):
+        self.factory.players.add(self)
+        peer = self.transport.getPeer()
+        self.host = peer.host
+        self.peer = "{}:{}".format(peer.host, peer.port)
+        self.backpressure = Backpressure(self.transport)
+        reaper.watch(self)
+        if self.adopted is not None:
+            # admitted by the worker that accepted the connection
+            self.factory.adopt(self)
+            player_info, command, data = self.adopted
+            self.name = player_info['name']
+            self.codec = player_info.get('codec', "pb2")
+            self.compress = player_info.get('compress', False)
+            self.binary = player_info.get('binary', False)
+            self.stringReceived(command)
+            return
+        self.factory.admit(self)
+
+    def makeConnection(self, transport):
+        NetstringReceiver.makeConnection(self, transport)
+        # the parser is only set up after connectionMade
+        if self.adopted is not None and self.adopted[2]:
+            self.dataReceived(self.adopted[2])  # pipelined after the command
+
+    def admitted(self):
+        self.state = "CONNECTED"
+        self.write(
+            "Welcome! There are currently %d open connections." %
+            (self.factory.numProtocols,))
+
+    def queued(self, position):
+        self.state = "QUEUED"
+        self.write("Server full, position {} in queue".format(position))
+
+    def refused(self, reason):
+        self.state = "DISCONNECTED"
+        self.write(reason)
+        self.transport.loseConnection()
+
+    def connectionLost(self, reason):
+        log.lifecycle.debug("dc %s %s", self.peer, id(self))
+        if self.compressed[0]:
+            raw, sent, seconds = self.compressed
+            log.lifecycle.info(
+                "%s %s compressed %d to %d bytes (%.0f%% saved) in %.1f ms",
+                self.peer, id(self), raw, sent, 100. * (raw - sent) / raw,
+                1000 * seconds)
+        self.factory.release(self)
+        self.factory.players.discard(self)
+        matchmaker.remove_player(self)
+        if self.match:  # should only exist if JOINED or STARTED
+            self.match.abort()
+        for session in (self.sessions or {}).values():
+            if session.match:
+                session.match.abort()
+        if self.spectator is not None:
+            self.spectator.detach()
+
+    def frame(self, state, data, tag=None):
+        # text, or the parts of a binary frame (see framing.py)
+        if self.binary:
+            return [framing.header(state, tag), data]
+        if tag is None:
+            return "{} {}".format(state, data)
+        return "@{} {} {}".format(tag, state, data)
+
+    def send_frame(self, frame):
+        parts = [frame] if isinstance(frame, str) else frame
+        if log.wire.debug_on:
+            log.wire.debug(">> %s %s: %r", self.peer, id(self), "".join(parts))
+        metrics.messages_out.inc()
+        length = sum(len(part) for part in parts)
+        if self.compress and length >= compress_min_bytes:
+            t = time.time()
+            data = compression.deflater.compress(parts)
+            seconds = time.time() - t
+            metrics.compress_seconds.observe(seconds)
+            metrics.compression_bytes.inc(length, "raw")
+            metrics.compression_bytes.inc(len(data), "compressed")
+            self.compressed[0] += length
+            self.compressed[1] += len(data)
+            self.compressed[2] += seconds
+            parts, length = [data], len(data)
+        metrics.bytes_out.inc(length)
+        # a netstring, written without joining the parts
+        self.transport.writeSequence(["{}:".format(length)] + parts + [","])
+
+    def write(self, data):
+        if self.state == "HANDOFF":
+            return  # the owning worker writes to the socket
+        self.send_frame(self.frame(self.state, data))
+
+    def drop(self):
+        self.transport.loseConnection()
+
+    def idle_limit(self):
+        if not self.transport.connected or not idle_limits['lobby']:
+            return None
+        if self.state == "CONNECTED" and not self.sessions:
+            return "lobby", idle_limits['lobby']
+        return None, idle_limits['lobby']  # busy, looked at again later
+
+    def reap(self, reason):
+        log.lifecycle.info("Dropping idle connection %s %s", self.peer,
+                           id(self))
+        self.state = "DISCONNECTED"
+        self.write("Idle for too long")
+        self.drop()
+        return {'connections': 1}
+
+    def dataReceived(self, data):
+        # data is kept until it was consumed, to pass it on to the owning
+        # worker if the connection is handed off
+        self.received += data
+        self.consumed = 0
+        NetstringReceiver.dataReceived(self, data)
+        self.received = self.received[self.consumed:]
+
+    def unconsumed(self):
+        # received after the netstring being handled
+        return self.received[self.consumed:]
+
+    def stringReceived(self, data):
+        self.consumed += len(str(len(data))) + len(data) + 2
+        if self.state == "HANDOFF":
+            return  # pipelined commands were passed on with the socket
+        if log.wire.debug_on:
+            log.wire.debug("<< %s %s: %r", self.peer, id(self), data)
+        self.last_active = time.time()
+        metrics.messages_in.inc()
+        metrics.bytes_in.inc(len(data))
+        if self.state == "QUEUED":
+            self.write("Server full, position {} in queue".format(
+                self.factory.queue.index(self) + 1))
+        elif self.sessions is not None:
+            self.mux_received(data)
+        elif self.state == "CONNECTED" and data == "MUX":
+            self.sessions = {}
+            self.MAX_LENGTH = mux_max_length
+            self.write("Multiplexing")
+        elif self.state == "CONNECTED" and data.startswith("BINARY "):
+            if data[len("BINARY "):] == str(framing.version):
+                self.binary = True
+                self.write("Binary framing {}".format(framing.version))
+            else:
+                self.write("Unknown framing version {}".format(
+                    data[len("BINARY "):]))
+        else:
+            self.handle(data)
+
+    def mux_received(self, data):
+        # @<match_id> <command>
+        if data.startswith("@"):
+            tag, _, command = data.partition(" ")
+            try:
+                session = self.sessions[tag[1:]]
+            except KeyError:
+                self.write("Not in match {}".format(tag[1:]))
+            else:
+                session.handle(command)
+        
+        # BATCH <netstring>*, each a tagged command
+        elif data.startswith("BATCH "):
+            try:
+                frames = split_netstrings(data[len("BATCH "):])
+            except ValueError:
+                self.write("Malformed batch")
+                return
+            for frame in frames:
+                if frame.startswith("@"):
+                    self.mux_received(frame)
+                else:
+                    self.write("Invalid batched command")
+        
+        else:
+            self.handle(data)
+
+    def join_match(self, match_id):
+        owner = match_owner(match_id)
+        if owner is not None and owner != cluster.worker_index:
+            if self.sessions is not None:
+                self.write("Match of another worker can not be multiplexed")
+                return
+            if cluster.handoff(self, owner, "JOIN {}".format(match_id)):
+                return
+        if self.sessions is None:
+            MatchSession.join_match(self, match_id)
+        elif match_id in self.sessions:
+            self.write("Already in match {}".format(match_id))
+        else:
+            session = MuxSession(self, match_id)
+            session.join_match(match_id)
+            if session.match is not None:
+                self.sessions[match_id] = session
+    
+    def queue_for_match(self, num_players):
+        # each worker's matchmaker only pairs its own players, so all of
+        # them queue at one worker
+        if (num_players > 1 and cluster.worker_index is not None and
+                cluster.worker_index != matchmaking_worker):
+            if self.sessions is not None:
+                self.write("Queue of another worker can not be multiplexed")
+                return
+            if cluster.handoff(self, matchmaking_worker,
+                               "QUEUE {}".format(num_players)):
+                return
+        if self.sessions is None:
+            MatchSession.queue_for_match(self, num_players)
+        elif num_players == 1:
+            start_matched([self])
+        else:
+            # the connection may be queued several times, each match
+            # found gets its own session
+            self.write("Searching for a match (rating {:.0f})".format(
+                matchmaking.rating(self.name)))
+            matchmaker.add(self)
+    
+    def seat(self, match_id):
+        if self.sessions is None:
+            return self
+        session = self.sessions[match_id] = MuxSession(self, match_id)
+        return session
+    
+    def watch_match(self, match_id):
+        owner = match_owner(match_id)
+        if self.sessions is not None:
+            self.write("Can not watch while multiplexing")
+            return
+        if owner is not None and owner != cluster.worker_index:
+            if cluster.handoff(self, owner, "WATCH {}".format(match_id)):
+                return
+        MatchSession.watch_match(self, match_id)
+    
+    def handoff_info(self):
+        return {'name': self.name, 'codec': self.codec,
+                'compress': self.compress, 'binary': self.binary}
+    
+    def handing_off(self):
+        # until the owner acknowledged, input and output are left to it
+        self.state = "HANDOFF"
+
+    def handed_off(self):
+        # the owning worker has its own copy of the socket now
+        self.state = "DISCONNECTED"
+        if self.transport.connected:
+            cluster.detach(self.transport)
         
         
 class PlayerFactory(Factory):
-    numProtocols = 0
+    """Admits up to `max_connections` players, queues up to `max_queued`
+    more and refuses the rest. `max_per_ip` limits the active and queued
+    connections of one address (0 for no limit)."""
+    numProtocols = 0  # active connections
+    def __init__(self, max_connections=8, max_queued=64, max_per_ip=0):
+        self.players = set()
+        self.max_connections = max_connections
+        self.max_queued = max_queued
+        self.max_per_ip = max_per_ip
+        self.queue = collections.deque()  # players waiting to be admitted
+        self.per_ip = {}  # host -> active and queued connections
+    
     def buildProtocol(self, addr):
         return Player(self)
     
+    def admit(self, player):
+        if (self.max_per_ip and
+                self.per_ip.get(player.host, 0) >= self.max_per_ip):
+            player.admission = "refused"
+            metrics.connections_refused.inc(1, "per_ip")
+            player.refused("Sorry, too many connections from your address!")
+            return
+        if self.numProtocols < self.max_connections:
+            self.count(player, "active")
+            player.admitted()
+        elif len(self.queue) < self.max_queued:
+            self.count(player, "queued")
+            self.queue.append(player)
+            player.queued(len(self.queue))
+        else:
+            player.admission = "refused"
+            metrics.connections_refused.inc(1, "full")
+            player.refused("Sorry, too many players connected!")
+    
+    def adopt(self, player):
+        # handed off by another worker, which admitted and welcomed it
+        # already: only counted, nothing is sent
+        self.count(player, "active")
+    
+    def count(self, player, admission):
+        player.admission = admission
+        if admission == "active":
+            self.numProtocols += 1
+        self.per_ip[player.host] = self.per_ip.get(player.host, 0) + 1
+    
+    def release(self, player):
+        if player.admission not in ("active", "queued"):
+            return
+        self.per_ip[player.host] -= 1
+        if not self.per_ip[player.host]:
+            del self.per_ip[player.host]
+        if player.admission == "queued":
+            position = self.queue.index(player)
+            del self.queue[position]
+        else:
+            self.numProtocols -= 1
+            position = 0
+            while self.queue and self.numProtocols < self.max_connections:
+                waiting = self.queue.popleft()
+                waiting.admission = "active"
+                self.numProtocols += 1
+                waiting.admitted()
+        player.admission = None
+        # everyone behind moved up
+        for i in range(position, len(self.queue)):
+            self.queue[i].queued(i + 1)
+    
+    def connection_states(self):
+        states = {}
+        for player in self.players:
+            states[(player.state,)] = states.get((player.state,), 0) + 1
+        return states
+    
 
 #import google.protobuf.socketrpc.server as server
 #server = server.SocketRpcServer(8007)
@@ -317,12 +1216,113 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Run a robotgame match/turn resolution service")
     parser.add_argument('host', type=str, help="Host to set for URIs")
     parser.add_argument('port', type=int, help="Port to run under")
+    parser.add_argument('--turn-processes', type=int, default=4,
+                        help="Worker processes resolving turns "
+                             "(0 resolves them on the reactor thread)")
+    parser.add_argument('--turn-timeout', type=float, default=30,
+                        help="Seconds before a turn the worker processes "
+                             "did not resolve aborts its match")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Server processes sharing the port")
+    parser.add_argument('--worker', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--listen-fd', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--metrics-port', type=int,
+                        help="Serve metrics over HTTP on this port "
+                             "(plus the worker index with --workers)")
+    parser.add_argument('--map-dir', action='append', default=[],
+                        help="Directory of maps that CREATE can choose "
+                             "with map=<name> (<name>.py in rgkit's format)")
+    parser.add_argument('--boards', action='store_true',
+                        help="Diff and encode states as numpy arrays, not "
+                             "measurably faster than GameStates "
+                             "(needs numpy)")
+    parser.add_argument('--max-connections', type=int, default=8,
+                        help="Players connected at the same time, more "
+                             "wait in a queue")
+    parser.add_argument('--max-queued', type=int, default=64,
+                        help="Players waiting for a connection slot, more "
+                             "are refused")
+    parser.add_argument('--max-per-ip', type=int, default=0,
+                        help="Connections (including queued ones) per "
+                             "address, 0 for no limit")
+    parser.add_argument('--write-watermark', type=int, metavar="BYTES",
+                        help="Stop reading from clients with more than "
+                             "BYTES of unsent output until it was sent "
+                             "(default 65536)")
+    parser.add_argument('--idle-limits', type=str,
+                        metavar="LOBBY:START:TURN",
+                        help="Seconds before idle lobby connections and "
+                             "matches waiting for players (LOBBY), full "
+                             "matches not STARTed (START) and turns without "
+                             "actions (TURN) are reaped, 0 for no limit "
+                             "(default 300:120:60)")
+    parser.add_argument('--record-dir', type=str,
+                        help="Record every match to a file in this directory "
+                             "(see recording.py)")
+    parser.add_argument('--log', action='append', default=[],
+                        metavar="CATEGORY=LEVEL[/N]",
+                        help="Set the log level of a category (wire, turns, "
+                             "lifecycle or all), logging only every Nth "
+                             "message, e.g. wire=debug/100")
 
     args = parser.parse_args()
     host = args.host
     port = args.port
+    record_dir = args.record_dir
+    use_boards = args.boards
+    if args.write_watermark is not None:
+        if args.write_watermark <= 0:
+            parser.error("Invalid --write-watermark")
+        write_high_watermark = args.write_watermark
+    if args.idle_limits is not None:
+        try:
+            limits = map(float, args.idle_limits.split(':'))
+            if len(limits) != 3 or min(limits) < 0:
+                raise ValueError
+        except ValueError:
+            parser.error("Invalid --idle-limits")
+        idle_limits = dict(zip(("lobby", "start", "turn"), limits))
+    if use_boards:
+        import board
+        if board.numpy is None:
+            parser.error("--boards needs numpy")
+    for spec in args.log:
+        try:
+            log.configure(spec)
+        except ValueError as e:
+            parser.error(str(e))
+    for map_dir in args.map_dir:
+        try:
+            maps.add_dir(map_dir)
+        except maps.MapError as e:
+            parser.error(str(e))
+
+    if args.workers > 1 and args.worker is None:
+        listening_socket = cluster.launch(args.workers, port, sys.argv)
+        reactor.run()
+        sys.exit()
 
-    reactor.suggestThreadPoolSize(4)
-    endpoint = TCP4ServerEndpoint(reactor, port)
-    endpoint.listen(PlayerFactory())
+    maps.apply(settings)
+    turns.turn_timeout = args.turn_timeout
+    turns.start_pool(args.turn_processes)
+    factory = PlayerFactory(args.max_connections, args.max_queued,
+                            args.max_per_ip)
+    metrics.Gauge("rg_matches", "Matches on this server by status",
+                  matches.counts, labels=("status",))
+    metrics.Gauge("rg_connections", "Player connections by state",
+                  factory.connection_states, labels=("state",))
+    metrics.Gauge("rg_matchmaking_queued", "Players waiting in the QUEUE",
+                  lambda: {(): len(matchmaker)})
+    metrics.Gauge("rg_reaper_watched", "Matches and connections the "
+                  "reaper checks for idleness", lambda: {(): len(reaper)})
+    if args.metrics_port is not None:
+        metrics.listen(reactor, args.metrics_port + (args.worker or 0))
+    if args.worker is None:
+        endpoint = TCP4ServerEndpoint(reactor, port)
+        endpoint.listen(factory)
+    else:
+        reactor.adoptStreamPort(args.listen_fd, socket.AF_INET, factory)
+        os.close(args.listen_fd)
+        cluster.start(args.worker, args.workers, port, factory,
+                      match_summaries)
     reactor.run()
@@ -0,0 +1,23 @@
+#test_server.py
+# python -m unittest test_server
+
+import unittest
+
+import server
+
+
+class SplitNetstringsTest(unittest.TestCase):
+    def test_frames(self):
+        self.assertEqual(server.split_netstrings("1:a,2:bc,0:,"),
+                         ["a", "bc", ""])
+        self.assertEqual(server.split_netstrings(""), [])
+
+    def test_malformed(self):
+        for data in ["1:a,-4:", "-1:,", "+1:a,", " 1:a,", "1 :a,", ":a,",
+                     "x:a,", "3:ab,", "1:a", "1:ab", "1:a,2:b",
+                     "12345678901:a,", "1:a,2"]:
+            self.assertRaises(ValueError, server.split_netstrings, data)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,195 @@
+#tournament.py
+# local tournaments between robot files. matches are played in-process
+# through rgkit's Game in a pool of worker processes, no sockets involved.
+# games are created and ended by the same code as networked matches
+# (games.new_game, games.game_over), so results match networked play.
+#
+#   python tournament.py bots/*.py --schedule swiss --rounds 5 --games 2
+
+import os
+import sys
+import time
+import random
+import itertools
+import multiprocessing
+
+from rgkit.game import Player, settings
+
+import maps
+import games
+
+
+class Standing(object):
+    def __init__(self, fname):
+        self.fname = fname
+        self.wins = self.draws = self.losses = 0
+        self.robots = 0  # robots left at the end, summed over all matches
+        self.opponents = set()
+
+    @property
+    def points(self):
+        return self.wins + 0.5 * self.draws
+
+    def add(self, score, other_score, other):
+        self.opponents.add(other)
+        self.robots += score
+        if score > other_score:
+            self.wins += 1
+        elif score < other_score:
+            self.losses += 1
+        else:
+            self.draws += 1
+
+
+def _init_worker(map_dirs):
+    for path in map_dirs:
+        maps.add_dir(path)
+    maps.apply(settings)
+
+
+def play(args):
+    """Play one match, returns (fnames, scores, turns played)."""
+    fnames, map_name, seed = args
+    random.seed(seed)
+    game = games.new_game([Player(file_name=fname) for fname in fnames],
+                          map_name)
+    while not games.game_over(game):
+        game.run_turn()
+    scores = [0] * len(fnames)
+    for bot in game._state.robots.itervalues():
+        scores[bot['player_id']] += 1
+    return fnames, scores, game._state.turn
+
+
+def round_robin(fnames, games):
+    """Every pairing, `games` times, alternating sides."""
+    pairs = []
+    for i in range(games):
+        for a, b in itertools.combinations(fnames, 2):
+            pairs.append((a, b) if i % 2 == 0 else (b, a))
+    return [pairs]
+
+
+def swiss_round(standings, games):
+    """Pair players with equal or close points, avoiding rematches where
+    possible. With an odd number of players the last one sits out."""
+    ranked = sorted(standings.values(),
+                    key=lambda s: (-s.points, -s.robots, s.fname))
+    pairs = []
+    while len(ranked) > 1:
+        a = ranked.pop(0)
+        i = next((i for i, b in enumerate(ranked)
+                  if b.fname not in a.opponents), 0)
+        b = ranked.pop(i)
+        for game in range(games):
+            pairs.append((a.fname, b.fname) if game % 2 == 0
+                         else (b.fname, a.fname))
+    return pairs
+
+
+class Tournament(object):
+    def __init__(self, fnames, schedule="round-robin", rounds=None, games=1,
+                 processes=None, map_name=None, seed=None):
+        self.fnames = fnames
+        self.schedule = schedule
+        self.rounds = rounds or len(fnames) - 1
+        self.games = games
+        self.map_name = map_name
+        self.seed = random.randrange(1 << 30) if seed is None else seed
+        self.pool = multiprocessing.Pool(processes, _init_worker,
+                                         (maps.map_dirs,))
+        self.standings = dict((fname, Standing(fname)) for fname in fnames)
+        self.matches = self.turns = 0
+        self.seconds = 0.0
+
+    def rounds_pairs(self):
+        if self.schedule == "round-robin":
+            for pairs in round_robin(self.fnames, self.games):
+                yield pairs
+        else:
+            for _ in range(self.rounds):
+                yield swiss_round(self.standings, self.games)
+
+    def run(self, verbose=True):
+        started = time.time()
+        for round_no, pairs in enumerate(self.rounds_pairs(), 1):
+            jobs = [(pair, self.map_name, self.seed + self.matches + i)
+                    for i, pair in enumerate(pairs)]
+            for fnames, scores, turns_played in self.pool.imap_unordered(
+                    play, jobs):
+                (a, b), (score_a, score_b) = fnames, scores
+                self.standings[a].add(score_a, score_b, b)
+                self.standings[b].add(score_b, score_a, a)
+                self.matches += 1
+                self.turns += turns_played
+                if verbose:
+                    print "round {}: {} {} - {} {}".format(
+                        round_no, name(a), score_a, score_b, name(b))
+        self.seconds = time.time() - started
+        return self.ranking()
+
+    def ranking(self):
+        return sorted(self.standings.values(),
+                      key=lambda s: (-s.points, -s.robots, s.fname))
+
+    def report(self):
+        width = max(len(name(fname)) for fname in self.fnames)
+        print "{:>3}  {:<{w}}  {:>6}  {:>4} {:>4} {:>4}  {:>7}".format(
+            "#", "robot", "points", "W", "D", "L", "robots", w=width)
+        for rank, s in enumerate(self.ranking(), 1):
+            print "{:>3}  {:<{w}}  {:>6}  {:>4} {:>4} {:>4}  {:>7}".format(
+                rank, name(s.fname), s.points, s.wins, s.draws, s.losses,
+                s.robots, w=width)
+        seconds = self.seconds or float('nan')
+        print "{} matches, {} turns in {:.1f}s: {:.2f} matches/s, " \
+              "{:.0f} turns/s (seed {})".format(
+                  self.matches, self.turns, self.seconds,
+                  self.matches / seconds, self.turns / seconds, self.seed)
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+
+def name(fname):
+    return os.path.splitext(os.path.basename(fname))[0]
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Run a local tournament between robot files")
+    parser.add_argument('robots', nargs='+', help="robot files")
+    parser.add_argument('--schedule', choices=['round-robin', 'swiss'],
+                        default='round-robin')
+    parser.add_argument('--rounds', type=int, default=None,
+                        help="Swiss rounds (default: number of robots - 1)")
+    parser.add_argument('--games', type=int, default=1,
+                        help="Matches per pairing, sides alternate")
+    parser.add_argument('--processes', type=int, default=None,
+                        help="Worker processes (default: one per CPU)")
+    parser.add_argument('--map', dest='map_name', default=None)
+    parser.add_argument('--map-dir', action='append', default=[])
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('-q', '--quiet', action='store_true')
+    args = parser.parse_args()
+
+    if len(set(args.robots)) < 2:
+        parser.error("need at least two robots")
+    try:
+        for path in args.map_dir:
+            maps.add_dir(path)
+        maps.path(args.map_name or maps.default_map)
+    except maps.MapError as e:
+        parser.error(str(e))
+
+    tournament = Tournament(sorted(set(args.robots)), args.schedule,
+                            args.rounds, args.games, args.processes,
+                            args.map_name, args.seed)
+    try:
+        tournament.run(verbose=not args.quiet)
+    except KeyboardInterrupt:
+        tournament.close()
+        sys.exit(1)
+    tournament.report()
+    tournament.close()
@@ -0,0 +1,90 @@
+#turns.py
+# turn resolution, either inline or in a pool of worker processes so that
+# slow turns do not block the reactor
+
+import multiprocessing
+import traceback
+
+from twisted.internet import defer, reactor
+
+from rgkit.game import settings
+import maps
+import games
+
+
+pool = None  # TurnPool, None to resolve turns on the reactor thread
+turn_timeout = 30  # seconds before a turn lost in the pool fails
+
+
+class TurnError(Exception):
+    pass
+
+
+def _init_worker():
+    maps.apply(settings)
+
+
+def _resolve(state, actions, map_name):
+    try:
+        maps.apply(settings, map_name)
+        delta = state.get_delta(actions)
+        return True, state.apply_delta(delta)
+    except Exception:
+        return False, traceback.format_exc()
+
+
+class TurnPool(object):
+    def __init__(self, processes):
+        self.processes = processes
+        self._pool = multiprocessing.Pool(processes, _init_worker)
+
+    def resolve(self, state, actions, map_name=None):
+        d = defer.Deferred()
+
+        def fire(result):
+            if d.called:  # timed out
+                return
+            timeout.cancel()
+            ok, value = result
+            if ok:
+                d.callback(value)
+            else:
+                d.errback(TurnError(value))
+
+        def expire():
+            # e.g. the worker died, apply_async never calls back then
+            d.errback(TurnError("Turn not resolved within {} s".format(
+                turn_timeout)))
+
+        timeout = reactor.callLater(turn_timeout, expire)
+        # callback runs in the pool's result handler thread
+        self._pool.apply_async(
+            _resolve, (state, actions, map_name),
+            callback=lambda result: reactor.callFromThread(fire, result))
+        return d
+
+    def close(self):
+        self._pool.terminate()
+        self._pool.join()
+
+
+def start_pool(processes):
+    global pool
+    if processes > 0:
+        pool = TurnPool(processes)
+        reactor.addSystemEventTrigger('before', 'shutdown', pool.close)
+    return pool
+
+
+def resolve(game, player_actions, map_name=None):
+    """Resolve the current turn of `game` on map `map_name`, returns a
+    Deferred firing with the new GameState. The game itself is only updated
+    by the caller when resolved in the pool."""
+    if pool is None:
+        maps.apply(settings, map_name)
+        return defer.maybeDeferred(games.run_turn, game)
+
+    actions = {}
+    for p_actions in player_actions:
+        actions.update(p_actions)
+    return pool.resolve(game._state, actions, map_name)